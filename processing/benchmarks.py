@@ -0,0 +1,656 @@
+"""Benchmarks for the processing pipeline on synthetic local data.
+
+Usage (from the processing directory):
+
+    python benchmarks.py get_datasets --rows 200000
+    python benchmarks.py merge --shards 2 8 32 128
+    python benchmarks.py apply_prompt --rows 1000000
+    python benchmarks.py prompt_templates --rows 1000000
+    python benchmarks.py parquet_codecs --rows 200000
+    python benchmarks.py json_writers --rows 200000
+    python benchmarks.py val_sampling --rows 500000
+    python benchmarks.py dedup --rows 200000 --workers 4
+    python benchmarks.py leakage --rows 200000 --workers 4
+    python benchmarks.py bucketing --rows 2000000 --replicas 8
+    python benchmarks.py list_join --rows 1000000
+"""
+import argparse
+import functools
+import multiprocessing as mp
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+@functools.lru_cache()
+def vocabulary(size=5000):
+    rng = np.random.default_rng(0)
+    return np.array(["".join(rng.choice(list("abcdefghij"), 6)) for _ in range(size)])
+
+
+def synthetic_documents(n, words=200, seed=0):
+    rng = np.random.default_rng(seed)
+    vocab = vocabulary()
+    lengths = rng.integers(words // 2, words * 2, n)
+    tokens = vocab[rng.integers(0, len(vocab), lengths.sum())]
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    return [" " + " ".join(tokens[bounds[i] : bounds[i + 1]]) + " " for i in range(n)]
+
+
+def write_synthetic_dataset(path, n_train, n_val, seed=0):
+    """Local dataset directory loadable with ``datasets.load_dataset(path)``."""
+    os.makedirs(path, exist_ok=True)
+    for split, n in [("train", n_train), ("validation", n_val)]:
+        pd.DataFrame(
+            {
+                "article": synthetic_documents(n, seed=seed),
+                "highlights": synthetic_documents(n, words=20, seed=seed + 1),
+            }
+        ).to_parquet(os.path.join(path, f"{split}.parquet"))
+
+
+def peak_rss_mb():
+    # ru_maxrss survives exec on Linux, so a spawned child would report its
+    # parent's peak; VmHWM belongs to the current address space only.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_isolated(fn, *args):
+    """Run ``fn`` in a fresh interpreter so peak RSS is not inherited."""
+    # an executor rather than a Pool: its workers may start processes of their own
+    with ProcessPoolExecutor(1, mp_context=mp.get_context("spawn")) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def _get_datasets(workdir, arrow):
+    from dataset import HFDataset
+
+    os.chdir(workdir)
+    start = time.perf_counter()
+    HFDataset(
+        col_map=["article", "highlights"], dataset_name="synthetic", arrow=arrow
+    ).get_datasets()
+    return time.perf_counter() - start, peak_rss_mb()
+
+
+def _baseline_get_datasets(workdir):
+    """The original get_datasets: every split through to_pandas, the prompt
+    prefixed by a lambda per row."""
+    import datasets
+
+    os.chdir(workdir)
+    prompt = "Summarize the following document:"
+    start = time.perf_counter()
+    df = datasets.load_dataset("synthetic")
+    train = df["train"].to_pandas()
+    val = df["validation"].to_pandas().sample(100)
+    for split, frame in [("train", train), ("val", val)]:
+        frame = frame.rename({"article": "source", "highlights": "target"}, axis=1)
+        frame["source"] = frame["source"].apply(lambda x: prompt + x.strip())
+        frame = frame[["source", "target"]]
+        frame["dataset_id"] = "synthetic"
+        frame.to_parquet(f"{split}_synthetic.parquet")
+    return time.perf_counter() - start, peak_rss_mb()
+
+
+def bench_get_datasets(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ["HF_DATASETS_CACHE"] = os.path.join(workdir, "hf_cache")
+        write_synthetic_dataset(os.path.join(workdir, "synthetic"), args.rows, 1000)
+        # Warm the datasets cache so both modes read the same Arrow files.
+        run_isolated(_get_datasets, workdir, True)
+        runs = [
+            ("baseline_to_pandas", _baseline_get_datasets, ()),
+            ("pandas", _get_datasets, (False,)),
+            ("arrow", _get_datasets, (True,)),
+        ]
+        results = []
+        for mode, fn, fn_args in runs:
+            seconds, rss = run_isolated(fn, workdir, *fn_args)
+            results.append(
+                {"mode": mode, "seconds": round(seconds, 2), "peak_rss_mb": round(rss)}
+            )
+    # pandas >= 3 keeps strings in Arrow, so to_pandas no longer copies them
+    # and the pandas mode costs about what the arrow mode does
+    dtype = pa.table({"s": ["x"]}).to_pandas()["s"].dtype
+    print(f"pandas {pd.__version__}, to_pandas strings as {dtype}")
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+def quadratic_merge(dataset_items):
+    """The original merge: pd.concat inside the loop."""
+    for i, dataset_item in enumerate(dataset_items):
+        if i == 0:
+            df = pd.read_parquet(dataset_item)
+        else:
+            df = pd.concat([df, pd.read_parquet(dataset_item)])
+    df.reset_index(inplace=True, drop=True)
+    return df
+
+
+def same_content(path, reference):
+    """Whether two parquet files hold the same rows, as read back by pandas."""
+    return pd.read_parquet(path).equals(pd.read_parquet(reference))
+
+
+def _merge(method, dataset_items, output):
+    import dataset_info
+
+    start = time.perf_counter()
+    if method == "quadratic":
+        quadratic_merge(dataset_items).to_parquet(output)
+    elif method == "concat":
+        dataset_info.merge(dataset_items).to_parquet(output)
+    else:
+        getattr(dataset_info, method)(dataset_items, output)
+    return time.perf_counter() - start, peak_rss_mb()
+
+
+def bench_merge(args):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_shards in args.shards:
+            rows = args.rows // n_shards
+            items = []
+            for i in range(n_shards):
+                path = os.path.join(workdir, f"train_{n_shards}_{i}.parquet")
+                pd.DataFrame(
+                    {
+                        "source": synthetic_documents(rows, seed=i),
+                        "target": synthetic_documents(rows, words=20, seed=i),
+                        "dataset_id": i,
+                    }
+                ).to_parquet(path)
+                items.append(path)
+            # Every other shard lacks dataset_id, as when it is left unset.
+            for path in items[1::2]:
+                pd.read_parquet(path).drop(columns="dataset_id").to_parquet(path)
+            reference = os.path.join(workdir, "reference.parquet")
+            quadratic_merge(items).to_parquet(reference)
+            for method in args.methods:
+                output = os.path.join(workdir, f"{method}.parquet")
+                seconds, rss = run_isolated(_merge, method, items, output)
+                results.append(
+                    {
+                        "shards": n_shards,
+                        "method": method,
+                        "seconds": round(seconds, 2),
+                        "peak_rss_mb": round(rss),
+                        "same_content": same_content(output, reference),
+                    }
+                )
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+def bench_apply_prompt(args):
+    from dataset import HFDataset
+
+    prompt = "Summarize the following document: "
+    hf_dataset = HFDataset(
+        col_map=["source", "target"], dataset_name="synthetic", prompt=prompt
+    )
+    df = pd.DataFrame({"source": synthetic_documents(args.rows, words=args.words)})
+
+    start = time.perf_counter()
+    expected = df["source"].apply(lambda x: prompt + x.strip())
+    lambda_seconds = time.perf_counter() - start
+
+    results = [{"method": "lambda", "seconds": lambda_seconds, "equal": True}]
+    for method, fn in [
+        ("series_str", lambda df: prompt + df["source"].str.strip()),
+        ("apply_prompt", lambda df: hf_dataset.apply_prompt(df.copy())["source"]),
+    ]:
+        start = time.perf_counter()
+        output = fn(df)
+        seconds = time.perf_counter() - start
+        results.append(
+            {
+                "method": method,
+                "seconds": seconds,
+                "equal": list(output) == list(expected),
+            }
+        )
+    results = pd.DataFrame(results)
+    results["rows_per_sec"] = (args.rows / results["seconds"]).round()
+    results["seconds"] = results["seconds"].round(2)
+    print(results.to_string(index=False))
+
+
+def bench_prompt_templates(args):
+    from prompts import PromptSet
+
+    table = pa.table(
+        {
+            "source": synthetic_documents(args.rows, words=args.words),
+            "title": synthetic_documents(args.rows, words=3, seed=1),
+        }
+    )
+    prompt_sets = {
+        "prefix": PromptSet.from_prompt("Summarize the following document: "),
+        "3_templates": PromptSet(
+            [
+                ("Summarize the following document: {source}", 2),
+                ("{source}\n\nTL;DR:", 1),
+                ("Write a summary of the article titled {title}:\n{source}", 1),
+            ]
+        ),
+    }
+    results = []
+    for name, prompt_set in prompt_sets.items():
+        start = time.perf_counter()
+        prompt_set.apply(table)
+        seconds = time.perf_counter() - start
+        results.append(
+            {
+                "prompts": name,
+                "seconds": round(seconds, 2),
+                "rows_per_sec": round(args.rows / seconds),
+            }
+        )
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+def bench_parquet_codecs(args):
+    from writers import ParquetOptions, write_parquet
+
+    table = pa.table(
+        {
+            "source": synthetic_documents(args.rows),
+            "target": synthetic_documents(args.rows, words=20, seed=1),
+            "dataset_id": np.zeros(args.rows, dtype=np.int64),
+        }
+    )
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for compression in args.codecs:
+            for use_dictionary in [True, False]:
+                options = ParquetOptions(
+                    max_rows_per_shard=args.max_rows_per_shard,
+                    row_group_size=args.row_group_size,
+                    compression=compression,
+                    use_dictionary=use_dictionary,
+                )
+                prefix = os.path.join(workdir, f"train_{compression}")
+                start = time.perf_counter()
+                paths = write_parquet(table, prefix, options)
+                seconds = time.perf_counter() - start
+                size = sum(os.path.getsize(p) for p in paths)
+                results.append(
+                    {
+                        "codec": compression,
+                        "dictionary": use_dictionary,
+                        "shards": len(paths),
+                        "seconds": round(seconds, 2),
+                        "write_mb_per_sec": round(table.nbytes / 1024**2 / seconds),
+                        "size_mb": round(size / 1024**2, 1),
+                        "ratio": round(table.nbytes / size, 2),
+                    }
+                )
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+def _write_json(method, parquet_path, prefix, batch_size):
+    import pyarrow.parquet as pq
+
+    from writers import JsonLinesWriter
+
+    start = time.perf_counter()
+    if method == "split":
+        pd.read_parquet(parquet_path).to_json(prefix + ".json", orient="split")
+    else:
+        writer = JsonLinesWriter(prefix, None if method == "jsonl" else method)
+        for batch in pq.ParquetFile(parquet_path).iter_batches(batch_size=batch_size):
+            writer.write(pa.Table.from_batches([batch]))
+        writer.close()
+    return time.perf_counter() - start, peak_rss_mb()
+
+
+def bench_json_writers(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        parquet_path = os.path.join(workdir, "input.parquet")
+        pd.DataFrame(
+            {
+                "source": synthetic_documents(args.rows),
+                "target": synthetic_documents(args.rows, words=20, seed=1),
+            }
+        ).to_parquet(parquet_path)
+        results = []
+        for method in ["split", "jsonl", "gzip", "zstd"]:
+            prefix = os.path.join(workdir, f"train_{method}")
+            seconds, rss = run_isolated(
+                _write_json, method, parquet_path, prefix, args.batch_size
+            )
+            path = [p for p in os.listdir(workdir) if p.startswith(f"train_{method}")]
+            results.append(
+                {
+                    "writer": method,
+                    "seconds": round(seconds, 2),
+                    "rows_per_sec": round(args.rows / seconds),
+                    "peak_rss_mb": round(rss),
+                    "size_mb": round(
+                        os.path.getsize(os.path.join(workdir, path[0])) / 1024**2, 1
+                    ),
+                }
+            )
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+def _sample_val(method, parquet_path, cache_dir, val_n):
+    import datasets
+
+    from dataset import HFDataset
+
+    dataset = datasets.Dataset.from_parquet(parquet_path, cache_dir=cache_dir)
+    start = time.perf_counter()
+    if method == "to_pandas_sample":
+        dataset.to_pandas().sample(val_n, random_state=0)
+    else:
+        hf_dataset = HFDataset(
+            col_map=["article", "highlights"], dataset_name="synthetic", val_n=val_n
+        )
+        hf_dataset.sample_val(dataset)
+    return time.perf_counter() - start, peak_rss_mb()
+
+
+def bench_val_sampling(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        parquet_path = os.path.join(workdir, "validation.parquet")
+        pd.DataFrame(
+            {
+                "article": synthetic_documents(args.rows),
+                "highlights": synthetic_documents(args.rows, words=20, seed=1),
+            }
+        ).to_parquet(parquet_path)
+        cache_dir = os.path.join(workdir, "hf_cache")
+        # Convert to the datasets Arrow cache once, outside the timings.
+        run_isolated(_sample_val, "sample_val", parquet_path, cache_dir, args.val_n)
+        results = []
+        for method in ["to_pandas_sample", "sample_val"]:
+            seconds, rss = run_isolated(
+                _sample_val, method, parquet_path, cache_dir, args.val_n
+            )
+            results.append(
+                {"method": method, "seconds": round(seconds, 3), "peak_rss_mb": round(rss)}
+            )
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+def write_duplicated_dataset(path, rows, duplicate_fraction=0.1, seed=0):
+    """Merged-style parquet where ``duplicate_fraction`` of the rows repeat an
+    earlier row: half verbatim, half with two words changed."""
+    rng = np.random.default_rng(seed)
+    n_unique = int(rows * (1 - duplicate_fraction))
+    documents = synthetic_documents(n_unique, seed=seed)
+    copies = rng.integers(0, n_unique, rows - n_unique)
+    for i, source in enumerate(copies):
+        words = documents[source].split()
+        if i % 2:
+            words[len(words) // 3] = words[2 * len(words) // 3] = "changed"
+        documents.append(" ".join(words))
+    table = pa.table(
+        {
+            "source": documents,
+            "target": synthetic_documents(rows, words=20, seed=seed + 1),
+            "dataset_id": pa.array(rng.choice(["a", "b", "c"], rows)),
+        }
+    )
+    import pyarrow.parquet as pq
+
+    pq.write_table(table, path, row_group_size=10_000)
+
+
+def _dedup(path, exact_only, workers):
+    from dedup import MinHashOptions, dedup_parquet
+
+    start = time.perf_counter()
+    report = dedup_parquet(
+        [path],
+        path + ".dedup",
+        options=None if exact_only else MinHashOptions(),
+        workers=workers,
+    )
+    return time.perf_counter() - start, peak_rss_mb(), report
+
+
+def bench_dedup(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "train.parquet")
+        write_duplicated_dataset(path, args.rows)
+        results = []
+        for exact_only in [True, False]:
+            seconds, rss, report = run_isolated(_dedup, path, exact_only, args.workers)
+            results.append(
+                {
+                    "mode": "exact" if exact_only else "exact+minhash",
+                    "seconds": round(seconds, 2),
+                    "rows_per_s": round(args.rows / seconds),
+                    "peak_rss_mb": round(rss),
+                    "removed": int((report["rows"] - report["kept"]).sum()),
+                }
+            )
+    print(f"{args.rows - int(args.rows * 0.9)} duplicates injected")
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+def _find_leaks(train_path, val_path, workers):
+    from leakage import find_leaks
+
+    start = time.perf_counter()
+    _, leaks = find_leaks([train_path], [val_path], workers=workers)
+    return time.perf_counter() - start, peak_rss_mb(), len(leaks)
+
+
+def bench_leakage(args):
+    import pyarrow.parquet as pq
+
+    with tempfile.TemporaryDirectory() as workdir:
+        train_path = os.path.join(workdir, "train.parquet")
+        val_path = os.path.join(workdir, "val.parquet")
+        sources = synthetic_documents(args.rows, words=args.words)
+        targets = synthetic_documents(args.rows, words=20, seed=1)
+        pq.write_table(
+            pa.table({"source": sources, "target": targets}),
+            train_path,
+            row_group_size=100_000,
+        )
+        # val_n rows, half of them copied from train with different casing
+        leaked = np.arange(0, args.rows, args.rows // (args.val_n // 2))[
+            : args.val_n // 2
+        ]
+        val_sources = [sources[i].upper() for i in leaked]
+        val_sources += synthetic_documents(args.val_n - len(leaked), seed=2)
+        val_targets = [targets[i] for i in leaked]
+        val_targets += synthetic_documents(args.val_n - len(leaked), words=20, seed=3)
+        pq.write_table(pa.table({"source": val_sources, "target": val_targets}), val_path)
+        seconds, rss, found = run_isolated(_find_leaks, train_path, val_path, args.workers)
+    print(
+        pd.DataFrame(
+            [
+                {
+                    "train_rows": args.rows,
+                    "seconds": round(seconds, 2),
+                    "rows_per_s": round(args.rows / seconds),
+                    "peak_rss_mb": round(rss),
+                    "leaked": len(leaked),
+                    "found": found,
+                }
+            ]
+        ).to_string(index=False)
+    )
+
+
+def bench_bucketing(args):
+    from bucketing import LengthBucketSampler, padding_ratio, read_lengths
+
+    if args.prefix:
+        lengths = read_lengths(args.prefix)
+    else:
+        # roughly the shape of summarization source lengths
+        rng = np.random.default_rng(0)
+        lengths = rng.lognormal(5.5, 0.8, args.rows).astype(np.int64) + 1
+    samplers = {
+        "random": LengthBucketSampler(
+            lengths, args.batch_size, boundaries=[lengths.max()]
+        ),
+        **{
+            f"{n}_buckets": LengthBucketSampler(lengths, args.batch_size, num_buckets=n)
+            for n in args.buckets
+        },
+        f"{args.buckets[-1]}_buckets_max_tokens": LengthBucketSampler(
+            lengths,
+            max_tokens=args.batch_size * int(np.mean(lengths)),
+            num_buckets=args.buckets[-1],
+        ),
+    }
+    results = []
+    for name, sampler in samplers.items():
+        ranks = []
+        start = time.perf_counter()
+        for rank in range(args.replicas):
+            sampler.rank, sampler.num_replicas = rank, args.replicas
+            ranks.append(list(sampler))
+        seconds = time.perf_counter() - start
+        batches = [batch for rank in ranks for batch in rank]
+        results.append(
+            {
+                "sampler": name,
+                "batches_per_rank": len(ranks[0]),
+                "padding_ratio": round(padding_ratio(lengths, batches), 3),
+                "seconds": round(seconds / args.replicas, 3),
+                "examples_per_s": round(len(lengths) * args.replicas / seconds),
+            }
+        )
+    print(f"{len(lengths)} examples, {args.replicas} ranks, epoch built per rank")
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+def synthetic_sentence_lists(n, max_sentences=8, words=15, seed=0):
+    """List<string> column of ``n`` rows of 0 to ``max_sentences`` sentences."""
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, max_sentences + 1, n)
+    sentences = pa.array(synthetic_documents(int(counts.sum()), words, seed))
+    offsets = pa.array(np.append(0, np.cumsum(counts)), pa.int32())
+    return pa.ListArray.from_arrays(offsets, sentences)
+
+
+def bench_list_join(args):
+    from transforms import join_lists
+
+    column = synthetic_sentence_lists(args.rows, args.sentences, args.words)
+    series = column.to_pandas()
+
+    start = time.perf_counter()
+    expected = series.apply(lambda x: "\n".join(x))
+    lambda_seconds = time.perf_counter() - start
+
+    results = [{"method": "lambda", "seconds": lambda_seconds, "equal": True}]
+    for method, fn in [
+        ("series_str_join", lambda: series.str.join("\n")),
+        ("join_lists", lambda: join_lists(column).to_pandas()),
+    ]:
+        start = time.perf_counter()
+        output = fn()
+        seconds = time.perf_counter() - start
+        results.append(
+            {
+                "method": method,
+                "seconds": seconds,
+                "equal": list(output) == list(expected),
+            }
+        )
+    results = pd.DataFrame(results)
+    results["rows_per_sec"] = (args.rows / results["seconds"]).round()
+    results["seconds"] = results["seconds"].round(3)
+    print(results.to_string(index=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = subparsers.add_parser("get_datasets")
+    p.add_argument("--rows", type=int, default=200_000)
+    p.set_defaults(func=bench_get_datasets)
+
+    p = subparsers.add_parser("merge")
+    p.add_argument("--rows", type=int, default=200_000)
+    p.add_argument("--shards", type=int, nargs="+", default=[2, 8, 32, 128])
+    p.add_argument(
+        "--methods",
+        nargs="+",
+        default=["quadratic", "concat", "merge_to_parquet"],
+    )
+    p.set_defaults(func=bench_merge)
+
+    p = subparsers.add_parser("apply_prompt")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--words", type=int, default=50)
+    p.set_defaults(func=bench_apply_prompt)
+
+    p = subparsers.add_parser("prompt_templates")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--words", type=int, default=50)
+    p.set_defaults(func=bench_prompt_templates)
+
+    p = subparsers.add_parser("parquet_codecs")
+    p.add_argument("--rows", type=int, default=200_000)
+    p.add_argument("--max_rows_per_shard", type=int, default=50_000)
+    p.add_argument("--row_group_size", type=int, default=10_000)
+    p.add_argument(
+        "--codecs", nargs="+", default=["none", "snappy", "zstd", "lz4", "gzip"]
+    )
+    p.set_defaults(func=bench_parquet_codecs)
+
+    p = subparsers.add_parser("json_writers")
+    p.add_argument("--rows", type=int, default=200_000)
+    p.add_argument("--batch_size", type=int, default=10_000)
+    p.set_defaults(func=bench_json_writers)
+
+    p = subparsers.add_parser("val_sampling")
+    p.add_argument("--rows", type=int, default=500_000)
+    p.add_argument("--val_n", type=int, default=100)
+    p.set_defaults(func=bench_val_sampling)
+
+    p = subparsers.add_parser("dedup")
+    p.add_argument("--rows", type=int, default=200_000)
+    p.add_argument("--workers", type=int, default=1)
+    p.set_defaults(func=bench_dedup)
+
+    p = subparsers.add_parser("leakage")
+    p.add_argument("--rows", type=int, default=200_000)
+    p.add_argument("--words", type=int, default=200)
+    p.add_argument("--val_n", type=int, default=600)
+    p.add_argument("--workers", type=int, default=1)
+    p.set_defaults(func=bench_leakage)
+
+    p = subparsers.add_parser("bucketing")
+    p.add_argument("--rows", type=int, default=2_000_000)
+    p.add_argument(
+        "--prefix", default=None, help="use the lengths of a pretokenized output"
+    )
+    p.add_argument("--batch_size", type=int, default=32)
+    p.add_argument("--buckets", type=int, nargs="+", default=[8, 32, 128])
+    p.add_argument("--replicas", type=int, default=8)
+    p.set_defaults(func=bench_bucketing)
+
+    p = subparsers.add_parser("list_join")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--sentences", type=int, default=8)
+    p.add_argument("--words", type=int, default=15)
+    p.set_defaults(func=bench_list_join)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,138 @@
+"""Length-bucketed batches over pretokenized outputs.
+
+``LengthBucketSampler`` groups examples of similar length into batches, so
+little of each batch is padding. Lengths are read from the offsets written
+by pretokenize.py next to ``<prefix>.parquet`` (nothing is tokenized at
+training time); any array of lengths works too.
+
+Examples are split into buckets at length quantiles. Every epoch the
+examples of each bucket are shuffled and cut into batches, consecutive
+batches are grouped into steps of ``num_replicas`` batches (one per rank,
+so all ranks of a step see similar lengths) and the steps are shuffled
+across buckets. Each rank yields its own batch of every step. All of this
+is a few vectorized passes over the indices, so an epoch of millions of
+examples is planned in well under a second.
+
+The sampler can be passed as ``batch_sampler`` to a torch ``DataLoader``;
+call ``set_epoch`` before each epoch, as with ``DistributedSampler``.
+"""
+import numpy as np
+
+from pretokenize import TokenizedDataset
+
+
+def read_lengths(prefix, column="source"):
+    """Token length of every example of the pretokenized ``<prefix>``."""
+    return TokenizedDataset(prefix).lengths(column)
+
+
+def quantile_boundaries(lengths, num_buckets):
+    """Upper length of each bucket, splitting ``lengths`` into about equally
+    sized buckets."""
+    quantiles = np.quantile(lengths, np.linspace(0, 1, num_buckets + 1)[1:])
+    return np.unique(np.ceil(quantiles).astype(np.int64))
+
+
+def padding_ratio(lengths, batches):
+    """Fraction of the padded batch tensors that is padding."""
+    sizes = np.array([len(batch) for batch in batches])
+    batch_lengths = lengths[np.concatenate(batches)]
+    longest = np.maximum.reduceat(batch_lengths, np.cumsum(sizes) - sizes)
+    return float(1 - batch_lengths.sum() / (longest * sizes).sum())
+
+
+class LengthBucketSampler:
+    """Yields batches (int64 index arrays) of examples of similar length.
+
+    Batches hold ``batch_size`` examples, or with ``max_tokens`` as many as
+    fit ``max_tokens`` at their bucket's longest length. ``boundaries`` are
+    the upper lengths of the buckets (default: ``num_buckets`` quantiles).
+    ``drop_last`` drops each bucket's partial batch and a partial last step;
+    otherwise the last step is completed with batches from the start of the
+    epoch, so every rank yields the same number of batches.
+    """
+
+    def __init__(self, lengths, batch_size=32, max_tokens=None, num_buckets=32,
+                 boundaries=None, shuffle=True, seed=0, num_replicas=1, rank=0,
+                 drop_last=False):
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"rank {rank} out of range for {num_replicas} replicas")
+        self.lengths = np.asarray(lengths)
+        if boundaries is None:
+            boundaries = quantile_boundaries(self.lengths, num_buckets)
+        self.boundaries = np.asarray(boundaries, dtype=np.int64)
+        # longer examples than the last boundary go to the last bucket
+        self.buckets = np.minimum(
+            np.searchsorted(self.boundaries, self.lengths),
+            len(self.boundaries) - 1,
+        )
+        self.counts = np.bincount(self.buckets, minlength=len(self.boundaries))
+        if max_tokens is None:
+            self.batch_sizes = np.full(len(self.boundaries), batch_size)
+        else:
+            longest = np.maximum(self.boundaries, 1)
+            longest[-1] = max(longest[-1], self.lengths.max(initial=1))
+            self.batch_sizes = np.maximum(max_tokens // longest, 1)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    @classmethod
+    def from_pretokenized(cls, prefix, column="source", **kwargs):
+        return cls(read_lengths(prefix, column), **kwargs)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def num_batches(self):
+        """Batches per bucket, over all ranks."""
+        if self.drop_last:
+            return self.counts // self.batch_sizes
+        return -(-self.counts // self.batch_sizes)
+
+    def __len__(self):
+        steps, remainder = divmod(int(self.num_batches().sum()), self.num_replicas)
+        return steps if self.drop_last or remainder == 0 else steps + 1
+
+    def epoch_batches(self):
+        """(indices, starts, ends) of all ranks' batches, in step order: batch
+        ``j`` is ``indices[starts[j]:ends[j]]`` and goes to rank ``j %
+        num_replicas``."""
+        rng = np.random.default_rng([self.seed, self.epoch])
+        order = np.arange(len(self.lengths))
+        if self.shuffle:
+            order = rng.permutation(order)
+        # stable sort by bucket keeps the shuffled order within buckets
+        indices = order[np.argsort(self.buckets[order], kind="stable")]
+        bucket_starts = np.cumsum(self.counts) - self.counts
+        num_batches = self.num_batches()
+        sizes = np.repeat(self.batch_sizes, num_batches)
+        first = np.cumsum(num_batches) - num_batches
+        position = np.arange(len(sizes)) - np.repeat(first, num_batches)
+        starts = np.repeat(bucket_starts, num_batches) + position * sizes
+        bucket_ends = np.repeat(bucket_starts + self.counts, num_batches)
+        ends = np.minimum(starts + sizes, bucket_ends)
+        num_steps = len(self)
+        total = num_steps * self.num_replicas
+        if total > len(starts):
+            # complete the last step by wrapping around
+            extra = np.arange(total - len(starts)) % max(len(starts), 1)
+            starts = np.append(starts, starts[extra])
+            ends = np.append(ends, ends[extra])
+        starts, ends = starts[:total], ends[:total]
+        steps = np.arange(num_steps)
+        if self.shuffle:
+            steps = rng.permutation(num_steps)
+        batches = (steps[:, None] * self.num_replicas + np.arange(self.num_replicas))
+        batches = batches.reshape(-1)
+        return indices, starts[batches], ends[batches]
+
+    def __iter__(self):
+        indices, starts, ends = self.epoch_batches()
+        for start, end in zip(
+            starts[self.rank :: self.num_replicas], ends[self.rank :: self.num_replicas]
+        ):
+            yield indices[start:end]
@@ -0,0 +1,166 @@
+"""Content-addressed cache of processed dataset outputs.
+
+``HFDataset.get_datasets`` computes a key from everything that determines
+its output (dataset name/config, col_map, prompt, val_n, dataset_keys, seed,
+the source of the subclass and of every pipeline module, ...). Each entry is a directory
+``<cache_dir>/<key>/`` holding copies of the output files and a ``meta.json``.
+Files are copied rather than hard linked, since writers truncate outputs in
+place and would otherwise corrupt the cached copy.
+"""
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+
+import pandas as pd
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "FLAN_PROCESSING_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "flan_summarizer", "processing"),
+)
+
+
+def pipeline_modules(module):
+    """``module`` and the modules it uses from its own directory, directly
+    or through one another, by name."""
+    directory = os.path.dirname(os.path.abspath(module.__file__))
+    found, stack = {}, [module]
+    while stack:
+        module = stack.pop()
+        if module.__name__ in found:
+            continue
+        found[module.__name__] = module
+        for value in vars(module).values():
+            if not inspect.ismodule(value):
+                name = getattr(value, "__module__", None)
+                value = sys.modules.get(name) if isinstance(name, str) else None
+            path = getattr(value, "__file__", None)
+            if path and os.path.dirname(os.path.abspath(path)) == directory:
+                stack.append(value)
+    return [found[name] for name in sorted(found)]
+
+
+def code_hash(cls, base):
+    """Hash of the source of ``cls`` and its bases down to ``base``, and of
+    the pipeline modules ``base``'s module uses (prompts, sampling,
+    transforms, writers, ...), so editing a subclass ``process`` or the
+    pipeline itself changes the key."""
+    sources = [
+        inspect.getsource(module)
+        for module in pipeline_modules(sys.modules[base.__module__])
+    ]
+    for c in cls.__mro__:
+        if issubclass(c, base):
+            try:
+                sources.append(inspect.getsource(c))
+            except (OSError, TypeError):
+                # e.g. defined interactively; fall back to the bytecode
+                sources.append(c.__qualname__ + repr(c.process.__code__.co_code))
+    return hashlib.sha256("\n".join(sources).encode()).hexdigest()
+
+
+def cache_key(fields):
+    payload = json.dumps(fields, sort_keys=True, default=repr)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ProcessingCache:
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def read_meta(self, key):
+        with open(os.path.join(self.entry_dir(key), "meta.json")) as f:
+            return json.load(f)
+
+    def write_meta(self, key, meta, entry_dir=None):
+        with open(os.path.join(entry_dir or self.entry_dir(key), "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def restore(self, key, directory="."):
+        """Copy the files of a cached entry into ``directory``. Returns the
+        restored paths, or None on a miss."""
+        entry_dir = self.entry_dir(key)
+        try:
+            meta = self.read_meta(key)
+        except (OSError, ValueError):
+            return None
+        paths = [os.path.join(directory, name) for name in meta["files"]]
+        for name, path in zip(meta["files"], paths):
+            shutil.copyfile(os.path.join(entry_dir, name), path)
+        meta["last_used"] = time.time()
+        self.write_meta(key, meta)
+        return paths
+
+    def store(self, key, paths, **meta):
+        """Copy ``paths`` into the cache under ``key``. The entry is built in
+        a temporary directory and renamed, so readers never see half of it."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = os.path.join(self.cache_dir, f".tmp-{key}-{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        try:
+            for path in paths:
+                shutil.copyfile(path, os.path.join(tmp_dir, os.path.basename(path)))
+            now = time.time()
+            meta.update(
+                files=[os.path.basename(p) for p in paths],
+                bytes=sum(os.path.getsize(p) for p in paths),
+                created=now,
+                last_used=now,
+            )
+            self.write_meta(key, meta, entry_dir=tmp_dir)
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            os.replace(tmp_dir, self.entry_dir(key))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def entries(self):
+        """One row per cache entry, least recently used first."""
+        rows = []
+        if os.path.isdir(self.cache_dir):
+            for key in os.listdir(self.cache_dir):
+                if key.startswith("."):
+                    continue
+                try:
+                    meta = self.read_meta(key)
+                except (OSError, ValueError):
+                    continue
+                rows.append(
+                    {
+                        "key": key,
+                        "dataset": meta.get("dataset_name"),
+                        "bytes": meta["bytes"],
+                        "age_days": (time.time() - meta["created"]) / 86400,
+                        "unused_days": (time.time() - meta["last_used"]) / 86400,
+                    }
+                )
+        columns = ["key", "dataset", "bytes", "age_days", "unused_days"]
+        entries = pd.DataFrame(rows, columns=columns)
+        return entries.sort_values("unused_days", ascending=False, ignore_index=True)
+
+    def evict(self, max_age_days=None, max_bytes=None):
+        """Remove entries unused for more than ``max_age_days``, then least
+        recently used entries until the cache holds at most ``max_bytes``.
+        Returns the evicted keys."""
+        entries = self.entries()
+        evicted = []
+        if max_age_days is not None:
+            expired = entries["unused_days"] > max_age_days
+            evicted += list(entries.loc[expired, "key"])
+            entries = entries[~expired]
+        if max_bytes is not None:
+            excess = entries["bytes"].sum() - max_bytes
+            for key, size in zip(entries["key"], entries["bytes"]):
+                if excess <= 0:
+                    break
+                evicted.append(key)
+                excess -= size
+        for key in evicted:
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+        return evicted
@@ -1,26 +1,62 @@
+import json
 import logging
 
 import datasets
 import pandas as pd
-from sklearn.model_selection import train_test_split
+import pyarrow as pa
+
+from cache import ProcessingCache, cache_key, code_hash
+from lengths import LengthProfiler
+from manifest import source_revision
+from metrics import DISABLED, StageMetrics
+from prompts import PromptSet
+from sampling import HashSplitter, batched, sample_indices
+from transforms import filter_rows, join_list_columns, map_batches, rows_to_batch
+from writers import (
+    JsonLinesWriter,
+    ParquetOptions,
+    ShardedParquetWriter,
+    lengths_path,
+    output_files,
+    remove_outputs,
+)
 
 logging.basicConfig(
     filename=f"HF_datasets_processing_logging",
     filemode="a",
     format="%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s",
     datefmt="%H:%M:%S",
-    level=logging.FATAL,
+    level=logging.INFO,
 )
 
+logger = logging.getLogger(f"HF_datasets")
 
-def filter(record):
-    return record.levelno != logging.FATAL
 
+def first_value(df, col):
+    """First value of ``col`` for either a DataFrame or a pyarrow Table."""
+    if isinstance(df, pa.Table):
+        return df[col][0].as_py()
+    return df[col].iloc[0]
 
-logger = logging.getLogger(f"HF_datasets")
+
+def to_arrow(df):
+    if isinstance(df, pa.Table):
+        return df
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def empty_like(df):
+    if isinstance(df, pa.Table):
+        return df.slice(0, 0)
+    return df.iloc[:0]
 
 
 class HFDataset:
+    # Format the ``process`` hook receives when running with ``arrow=True``.
+    # Subclasses whose ``process`` works on pyarrow Tables can set this to
+    # "arrow" so that no pandas conversion happens at all.
+    process_format = "pandas"
+
     def __init__(
         self,
         col_map,
@@ -30,77 +66,455 @@ class HFDataset:
         dataset_keys=["train", "validation"],
         val_n=100,
         save=True,
+        arrow=False,
+        streaming=False,
+        batch_size=10_000,
+        seed=0,
+        split_key="content",
+        cache=None,
+        parquet_options=None,
+        output_format="parquet",
+        jsonl_compression=None,
+        length_policy=None,
+        metrics_path=None,
+        revision=None,
+        num_proc=1,
+        join_columns=None,
+        filters=None,
     ):
         self.col_map = {"source": col_map[0], "target": col_map[1]}
         self.dataset_keys = dataset_keys
         self.dataset_name = dataset_name
+        # A plain prefix string, a list of templates or a PromptSet
         self.prompt = prompt
+        self.prompts = PromptSet.from_prompt(prompt, seed=seed)
         self.val_n = val_n
         self.dataset_id = dataset_id
         self.save = save
+        self.arrow = arrow
+        # Streaming keeps at most ``batch_size`` (+ ``val_n``) rows in memory.
+        self.streaming = streaming
+        self.batch_size = batch_size
+        self.seed = seed
+        # Validation rows carved out of train are chosen by a hash of the row
+        # "content" (source and target) or of its "index"; see
+        # sampling.HashSplitter. Existing validation splits are always
+        # sampled by index.
+        self.split_key = split_key
+        # A ProcessingCache, or True for the default cache directory
+        self.cache = ProcessingCache() if cache is True else cache
+        # Sharding, row group size, compression and dictionary encoding
+        self.parquet_options = parquet_options or ParquetOptions()
+        # "parquet" or "jsonl"; JSON Lines can be "gzip" or "zstd" compressed
+        self.output_format = output_format
+        self.jsonl_compression = jsonl_compression
+        # A lengths.LengthPolicy: token length statistics, and optionally
+        # filtering or truncation, of the final source and target
+        self.length_policy = length_policy
+        self.length_profiler = None
+        # Per-stage timing and memory (see metrics.py), appended as a JSON
+        # line to ``metrics_path``; not recorded when it is None
+        self.metrics_path = metrics_path
+        self.metrics = DISABLED
+        # Version of the source dataset to load (a hub branch, tag or commit),
+        # and what was actually loaded; see manifest.source_revision
+        self.revision = revision
+        self.source_revision = None
+        # Worker processes for ``process_batch``/``process_example``
+        self.num_proc = num_proc
+        # Columns (after renaming) of lists of sentences, joined with
+        # newlines by ``process_batch``; see transforms.join_lists
+        self.join_columns = list(join_columns or [])
+        # {name: value} of transforms.FILTERS, applied after joining; the
+        # validation split may end up with fewer than ``val_n`` rows
+        self.filters = dict(filters or {})
+
+    def __getstate__(self):
+        # sent to worker processes by map_batches; run state stays behind
+        state = dict(self.__dict__)
+        state.update(metrics=DISABLED, length_profiler=None, cache=None)
+        return state
+
+    def output_prefix(self, split):
+        return f"""{split}_{self.dataset_name.split('/')[0]}"""
+
+    def output_path(self, split, ext="parquet"):
+        return f"{self.output_prefix(split)}.{ext}"
+
+    def output_files(self):
+        """Parquet files (or shards and their index) currently written."""
+        return output_files(self.output_prefix("train")) + output_files(
+            self.output_prefix("val")
+        )
+
+    def cache_fields(self, data_dir=None):
+        """Everything that determines the output files of ``get_datasets``."""
+        return {
+            "dataset_name": self.dataset_name,
+            "data_dir": data_dir,
+            "col_map": self.col_map,
+            "prompt": [(t.template, t.weight) for t in self.prompts.templates],
+            "val_n": self.val_n,
+            "dataset_keys": list(self.dataset_keys),
+            "dataset_id": self.dataset_id,
+            "revision": self.revision,
+            "join_columns": self.join_columns,
+            "filters": self.filters,
+            "seed": self.seed,
+            "arrow": self.arrow,
+            "streaming": self.streaming,
+            "split_key": self.split_key,
+            "parquet_options": vars(self.parquet_options),
+            "output_format": self.output_format,
+            "jsonl_compression": self.jsonl_compression,
+            "length_policy": vars(self.length_policy) if self.length_policy else None,
+            "code": code_hash(type(self), HFDataset),
+        }
 
     def rename_cols(self, df):
         col_map = dict(zip(self.col_map.values(), self.col_map.keys()))
+        if isinstance(df, pa.Table):
+            return df.rename_columns([col_map.get(c, c) for c in df.column_names])
         df = df.rename(col_map, axis=1)
         return df
 
-    def save_format(self, train, val, parquet=True):
+    def open_writer(self, split, parquet=True):
         if parquet:
-            train.to_parquet(f"""train_{self.dataset_name.split('/')[0]}.parquet""")
-            val.to_parquet(f"""val_{self.dataset_name.split('/')[0]}.parquet""")
-        else:
-            train.to_json(
-                f"""train_{self.dataset_name.split('/')[0]}.json""", orient="split"
-            )
-            val.to_json(
-                f"""val_{self.dataset_name.split('/')[0]}.json""", orient="split"
+            return ShardedParquetWriter(
+                self.output_prefix(split), self.parquet_options
             )
+        return JsonLinesWriter(
+            self.output_prefix(split), self.jsonl_compression, self.batch_size
+        )
+
+    def save_format(self, train, val, parquet=True):
+        with self.metrics.stage("save") as stage:
+            for split, df in [("train", train), ("val", val)]:
+                writer = self.open_writer(split, parquet)
+                writer.write(to_arrow(df))
+                writer.close()
+            self.save_length_stats()
+            stage.add_rows(len(train) + len(val))
 
     def apply_prompt(self, df):
-        df["source"] = df["source"].apply(lambda x: self.prompt + x.strip())
+        if isinstance(df, pa.Table):
+            return df.set_column(
+                df.schema.get_field_index("source"),
+                "source",
+                self.prompts.apply(df),
+            )
+        if df.empty:
+            # nothing to render, and object columns of no rows have no type
+            return df
+        columns = {
+            field: pa.array(df[field], from_pandas=True)
+            for field in self.prompts.fields
+        }
+        source = self.prompts.apply(pa.table(columns)).to_pandas()
+        source.index = df.index
+        df["source"] = source
         return df
 
     def process(self, train, val):
         return train, val
 
-    def get_datasets(self, data_dir=None):
+    def process_batch(self, batch):
+        """Transform a pyarrow Table of up to ``batch_size`` rows (after
+        renaming). Overriding this (or ``process_example``) runs it on train
+        and validation in ``num_proc`` processes, before ``process``."""
+        if self.join_columns:
+            batch = join_list_columns(batch, self.join_columns)
+        if self.filters:
+            batch = filter_rows(batch, self.filters)
+        if type(self).process_example is not HFDataset.process_example:
+            batch = rows_to_batch(self.process_example, batch)
+        return batch
+
+    def process_example(self, example):
+        """Transform one row, given and returned as a dict."""
+        return example
+
+    def has_batch_transform(self):
+        cls = type(self)
+        return (
+            bool(self.join_columns or self.filters)
+            or cls.process_batch is not HFDataset.process_batch
+            or cls.process_example is not HFDataset.process_example
+        )
+
+    def map_batches(self, df):
+        if not isinstance(df, pa.Table) and df.empty:
+            # see apply_prompt
+            return df
+        table = map_batches(
+            to_arrow(df), self.process_batch, self.num_proc, self.batch_size
+        )
+        return table if isinstance(df, pa.Table) else table.to_pandas()
+
+    def run_process(self, train, val):
+        """Call ``process``, converting Arrow tables to pandas only if the
+        subclass overrides ``process`` and asks for pandas input. Batch
+        transforms run first."""
+        if self.has_batch_transform():
+            train, val = self.map_batches(train), self.map_batches(val)
+        if (
+            isinstance(train, pa.Table)
+            and self.process_format == "pandas"
+            and type(self).process is not HFDataset.process
+        ):
+            train, val = self.process(train.to_pandas(), val.to_pandas())
+            return (
+                pa.Table.from_pandas(train, preserve_index=False),
+                pa.Table.from_pandas(val, preserve_index=False),
+            )
+        return self.process(train, val)
+
+    def load(self, data_dir=None):
         if len(self.dataset_name.split("/")) == 2:
             name = self.dataset_name.split("/")
-            df = datasets.load_dataset(name[0], name[1], data_dir=data_dir)
-        else:
-            df = datasets.load_dataset(self.dataset_name, data_dir=data_dir)
-        try:
+            return datasets.load_dataset(
+                name[0],
+                name[1],
+                data_dir=data_dir,
+                streaming=self.streaming,
+                revision=self.revision,
+            )
+        return datasets.load_dataset(
+            self.dataset_name,
+            data_dir=data_dir,
+            streaming=self.streaming,
+            revision=self.revision,
+        )
+
+    def splitter(self):
+        columns = None
+        if self.split_key == "content":
+            columns = [self.col_map["source"], self.col_map["target"]]
+        return HashSplitter(self.val_n, columns, seed=self.seed)
+
+    def hash_split(self, table):
+        # batch by batch, so only batch_size rows are hashed (and, for
+        # split_key="content", copied to pandas) at a time; the split does
+        # not depend on batch boundaries
+        splitter = self.splitter()
+        train = [
+            splitter.split(table.slice(start, self.batch_size))
+            for start in range(0, max(table.num_rows, 1), self.batch_size)
+        ]
+        return pa.concat_tables(train), splitter.finalize()
+
+    def split_arrow(self, df):
+        # Splits are memory-mapped Arrow tables; only the sampled rows are
+        # gathered, nothing goes through pandas.
+        with self.metrics.stage("split") as stage:
+            train = df[self.dataset_keys[0]].with_format("arrow")[:]
             if self.dataset_keys[1] not in df.keys():
-                logger.fatal(f"{self.dataset_name} no validation")
-                train = df[self.dataset_keys[0]].to_pandas()
-                train, val = train_test_split(train, test_size=self.val_n)
+                logger.warning(f"{self.dataset_name} no validation")
+                train, val = self.hash_split(train)
             else:
-                train = df[self.dataset_keys[0]].to_pandas()
-                val = df[self.dataset_keys[1]].to_pandas().sample(self.val_n)
+                val = self.sample_val(df[self.dataset_keys[1]])
+            stage.add_rows(len(train) + len(val))
+        return train, val
+
+    def sample_val(self, dataset):
+        """Pick ``val_n`` row indices first and gather only those rows, so
+        memory is O(val_n) however large the validation split is."""
+        indices = sample_indices(len(dataset), self.val_n, seed=self.seed)
+        return dataset.select(indices).with_format("arrow")[:]
+
+    def split_pandas(self, df):
+        train, val = self.split_arrow(df)
+        with self.metrics.stage("to_pandas") as stage:
+            stage.add_rows(len(train) + len(val))
+            return train.to_pandas(), val.to_pandas()
+
+    def select_cols(self, df):
+        if isinstance(df, pa.Table):
+            df = df.select(["source", "target"])
+            if self.dataset_id is not None:
+                df = df.append_column(
+                    "dataset_id", pa.repeat(self.dataset_id, df.num_rows)
+                )
+            return df
+        df = df[["source", "target"]]
+        if self.dataset_id is not None:
+            df["dataset_id"] = self.dataset_id
+        return df
+
+    def apply_length_policy(self, df, split):
+        if self.length_policy is None:
+            return df
+        if self.length_profiler is None:
+            self.length_profiler = LengthProfiler(self.length_policy)
+        return self.length_profiler.apply(df, split)
+
+    def save_length_stats(self):
+        """Write the token length statistics next to the train output."""
+        if self.length_profiler is not None:
+            self.length_profiler.write(
+                lengths_path(self.output_prefix("train")),
+                dataset_name=self.dataset_name,
+                dataset_id=self.dataset_id,
+            )
+
+    def transform(self, train, val):
+        with self.metrics.stage("rename") as stage:
             train = self.rename_cols(train)
             val = self.rename_cols(val)
-            train, val = self.process(train, val)
+            stage.add_rows(len(train) + len(val))
+        with self.metrics.stage("process") as stage:
+            train, val = self.run_process(train, val)
+            stage.add_rows(len(train) + len(val))
+        with self.metrics.stage("prompt") as stage:
             train = self.apply_prompt(train)
             val = self.apply_prompt(val)
-            train = train[["source", "target"]]
-            val = val[["source", "target"]]
-            if self.dataset_id is not None:
-                train["dataset_id"] = self.dataset_id
-                val["dataset_id"] = self.dataset_id
+            stage.add_rows(len(train) + len(val))
+        with self.metrics.stage("select") as stage:
+            train = self.select_cols(train)
+            val = self.select_cols(val)
+            stage.add_rows(len(train) + len(val))
+        if self.length_policy is not None:
+            with self.metrics.stage("lengths") as stage:
+                train = self.apply_length_policy(train, "train")
+                val = self.apply_length_policy(val, "val")
+                stage.add_rows(len(train) + len(val))
+        return train, val
+
+    def from_arrow(self, table):
+        return table if self.arrow else table.to_pandas()
+
+    def stream_batches(self, dataset):
+        for records in batched(dataset, self.batch_size):
+            yield pa.Table.from_pylist(records)
+
+    def get_datasets_streaming(self, data_dir=None):
+        """Process the dataset batch by batch, appending each processed train
+        batch to the train output so memory does not grow with the size of
+        the dataset.
+
+        Validation rows are picked by ``HashSplitter`` in the same single
+        pass: from the validation split if there is one (the rest of it is
+        dropped), otherwise from train.
+        """
+        with self.metrics.stage("load"):
+            df = self.load(data_dir)
+        self.source_revision = source_revision(df, self.revision)
+        has_val = self.dataset_keys[1] in df.keys()
+        if not has_val:
+            logger.warning(f"{self.dataset_name} no validation")
+        parquet = self.output_format == "parquet"
+
+        splitter = self.splitter()
+        writer = self.open_writer("train", parquet)
+        n_rows = 0
+        try:
+            for batch in self.stream_batches(df[self.dataset_keys[0]]):
+                if not has_val:
+                    with self.metrics.stage("split") as stage:
+                        batch = splitter.split(batch)
+                        stage.add_rows(len(batch))
+                if not self.arrow:
+                    with self.metrics.stage("to_pandas") as stage:
+                        batch = batch.to_pandas()
+                        stage.add_rows(len(batch))
+                batch, _ = self.transform(batch, empty_like(batch))
+                with self.metrics.stage("save") as stage:
+                    writer.write(to_arrow(batch))
+                    stage.add_rows(len(batch))
+                n_rows += len(batch)
+        finally:
+            writer.close()
+
+        with self.metrics.stage("split") as stage:
+            if has_val:
+                # same rows as sample_val picks in the in-memory modes
+                splitter = HashSplitter(self.val_n, seed=self.seed)
+                for batch in self.stream_batches(df[self.dataset_keys[1]]):
+                    splitter.split(batch)
+            val = splitter.finalize()
+            stage.add_rows(len(val))
+        with self.metrics.stage("to_pandas"):
+            val = self.from_arrow(val)
+        _, val = self.transform(empty_like(val), val)
+        with self.metrics.stage("save") as stage:
+            val_writer = self.open_writer("val", parquet)
+            val_writer.write(to_arrow(val))
+            val_writer.close()
+            self.save_length_stats()
+            stage.add_rows(len(val))
+        print(f"{self.dataset_name} length: {n_rows/1000}k")
+        logger.info(f"{self.dataset_name} length: {n_rows/1000}k")
+
+    def get_datasets(self, data_dir=None):
+        if self.cache is None or not self.save:
+            return self.build_datasets(data_dir)
+        key = cache_key(self.cache_fields(data_dir))
+        for split in ["train", "val"]:
+            remove_outputs(self.output_prefix(split))
+        if self.cache.restore(key):
+            print(f"{self.dataset_name} restored from cache {key[:12]}")
+            self.source_revision = self.cache.read_meta(key).get("source_revision")
+            return
+        result = self.build_datasets(data_dir)
+        if result != 0:
+            self.cache.store(
+                key,
+                self.output_files(),
+                dataset_name=self.dataset_name,
+                source_revision=self.source_revision,
+            )
+        return result
+
+    def build_datasets(self, data_dir=None):
+        self.length_profiler = None
+        if self.metrics_path is None:
+            return self.build_outputs(data_dir)
+        self.metrics = StageMetrics(
+            dataset_name=self.dataset_name,
+            dataset_id=self.dataset_id,
+            arrow=self.arrow,
+            streaming=self.streaming,
+        )
+        try:
+            result = self.build_outputs(data_dir)
+            self.metrics.meta["status"] = "failed" if result == 0 else "ok"
+            return result
+        finally:
+            self.metrics.meta.setdefault("status", "failed")
+            self.metrics.write(self.metrics_path)
+            logger.info(json.dumps(self.metrics.to_dict()))
+            self.metrics = DISABLED
+
+    def build_outputs(self, data_dir=None):
+        if self.streaming:
+            try:
+                return self.get_datasets_streaming(data_dir)
+            except Exception:
+                logger.exception(f"PROBLEM with: {self.dataset_name}")
+                return 0
+        with self.metrics.stage("load"):
+            df = self.load(data_dir)
+        self.source_revision = source_revision(df, self.revision)
+        try:
+            if self.arrow:
+                train, val = self.split_arrow(df)
+            else:
+                train, val = self.split_pandas(df)
+            train, val = self.transform(train, val)
             if self.save:
-                self.save_format(train, val)
+                self.save_format(train, val, self.output_format == "parquet")
                 print(f"{self.dataset_name} length: {len(train)/1000}k")
                 print(
-                    f"""example: {train['source'][0]}
-                        \n\n summary: {train['target'][0]}"""
+                    f"""example: {first_value(train, 'source')}
+                        \n\n summary: {first_value(train, 'target')}"""
                 )
-                logger.fatal(f"{self.dataset_name} length: {len(train)/1000}k")
-                logger.fatal(
-                    f"""example: {train['source'][0]}
-                        \n\n summary: {train['target'][0]}"""
+                logger.info(f"{self.dataset_name} length: {len(train)/1000}k")
+                logger.info(
+                    f"""example: {first_value(train, 'source')}
+                        \n\n summary: {first_value(train, 'target')}"""
                 )
             else:
                 return train, val
-        except:
-            logger.fatal(f"PROBLEM with: {self.dataset_name}")
+        except Exception:
+            logger.exception(f"PROBLEM with: {self.dataset_name}")
             return 0
@@ -1,73 +1,671 @@
+import argparse
 import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import replace
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-from dataset import HFDataset
+from cache import ProcessingCache
+from dedup import MinHashOptions, dedup_parquet
+from leakage import find_leaks, leakage_report, remove_leaks
+from lengths import LengthPolicy, read_length_stats
+from manifest import (
+    MANIFEST_PATH,
+    file_entry,
+    read_manifest,
+    schema_fields,
+    unchanged,
+    update_datasets,
+    update_merged,
+    validate_manifest,
+    write_manifest,
+)
+from mixing import Mixture, output_dataset_id
+from packing import pack_dataset
+from pretokenize import pretokenize
+from prompts import PromptSet
+from registry import PROCESSORS, read_registry, registry_table, registry_weights
+from writers import ParquetOptions, conform, merge_schema, output_files
 
 
-class Scitldr(HFDataset):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
+def build_dataset(spec, val_n=100, parquet_options=None, **kwargs):
+    """HFDataset for one registry.DatasetSpec and the data_dir to load it
+    from. The spec's val_n and shard settings take precedence."""
+    parquet_options = replace(
+        parquet_options or ParquetOptions(), **spec.shard_options()
+    )
+    hf_dataset = PROCESSORS[spec.processor](
+        col_map=[spec.source_key, spec.target_key],
+        dataset_name=spec.hf_dataset_key,
+        prompt=spec.prompt,
+        dataset_id=spec.hf_dataset_key,
+        dataset_keys=[spec.train_split, spec.val_split],
+        val_n=val_n if spec.val_n is None else spec.val_n,
+        revision=spec.revision,
+        join_columns=spec.join_columns,
+        filters=spec.filters,
+        parquet_options=parquet_options,
+        **kwargs,
+    )
+    return hf_dataset, spec.data_dir
 
-    def process(self, train, val):
-        for df in [train, val]:
-            df["source"] = df["source"].apply(lambda x: "\n".join(x))
-            df["target"] = df["target"].apply(lambda x: "\n".join(x))
-        return train, val
 
+def output_stats(hf_dataset):
+    stats = {"output_bytes": 0}
+    for split in ["train", "val"]:
+        for path in output_files(hf_dataset.output_prefix(split)):
+            # row counts come from parquet metadata; unknown for JSON Lines
+            if path.endswith(".parquet"):
+                rows = stats.get(f"{split}_rows") or 0
+                stats[f"{split}_rows"] = rows + pq.read_metadata(path).num_rows
+            stats["output_bytes"] += os.path.getsize(path)
+    return stats
 
-def process_datasets(df, val_n=100):
-    for i, row in df.iterrows():
-        dataset_name = row["hf_dataset_key"]
-        hf_dataset = HFDataset(
-            col_map=[row["source_key"], row["target_key"]],
-            dataset_name=row["hf_dataset_key"],
-            prompt=row["flan_prompt"],
-            val_n=val_n,
-        )
-        if dataset_name == "wikihow/all":
-            # Need to manually download wikihowAll.csv and place in directory
-            hf_dataset.get_datasets(data_dir=".")
-        elif "scitldr" in dataset_name:
-            # specific processing
-            hf_dataset = Scitldr(
-                col_map=[row["source_key"], row["target_key"]],
-                dataset_name=row["hf_dataset_key"],
-                prompt=row["flan_prompt"],
-                val_n=val_n,
-            )
-            hf_dataset.get_datasets()
-        else:
-            hf_dataset.get_datasets()
 
+def manifest_entry(hf_dataset, spec, seconds):
+    return {
+        "dataset_id": hf_dataset.dataset_id,
+        "prompt": spec.prompt,
+        "source": hf_dataset.source_revision,
+        "seconds": seconds,
+        "files": [file_entry(path) for path in hf_dataset.output_files()],
+    }
 
-def merge(dataset_items):
-    for i, dataset_item in enumerate(dataset_items):
-        if i == 0:
-            df = pd.read_parquet(dataset_item)
 
+def empty_summary(spec, status="ok"):
+    return {
+        "dataset": spec.hf_dataset_key,
+        "status": status,
+        "train_rows": None,
+        "val_rows": None,
+        "output_bytes": None,
+        "seconds": None,
+    }
+
+
+def process_row(spec, val_n=100, **kwargs):
+    """Process a single registry row, returning a summary dict. Never raises."""
+    start = time.perf_counter()
+    summary = empty_summary(spec)
+    try:
+        hf_dataset, data_dir = build_dataset(spec, val_n=val_n, **kwargs)
+        if hf_dataset.get_datasets(data_dir=data_dir) == 0:
+            summary["status"] = "failed"
         else:
-            new_item = pd.read_parquet(dataset_item)
-            df = pd.concat([df, new_item])
+            summary.update(output_stats(hf_dataset))
+    except Exception as e:
+        summary["status"] = f"failed: {e!r}"
+    summary["seconds"] = round(time.perf_counter() - start, 1)
+    if summary["status"] == "ok":
+        summary["manifest"] = manifest_entry(hf_dataset, spec, summary["seconds"])
+    return summary
+
+
+def process_row_isolated(spec, val_n=100, **kwargs):
+    # A dedicated single-worker pool per dataset: a crash (e.g. OOM kill)
+    # only breaks this dataset's pool, not the others.
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(process_row, spec, val_n, **kwargs).result()
+        except Exception as e:
+            return empty_summary(spec, status=f"failed: {e!r}")
 
-    df.reset_index(inplace=True, drop=True)
+
+def process_datasets(specs, val_n=100, workers=1, manifest_path=MANIFEST_PATH,
+                     **kwargs):
+    """Process the registry.DatasetSpecs of ``read_registry``."""
+    # kwargs are forwarded to every HFDataset, e.g. arrow=True or streaming=True
+    if workers <= 1:
+        results = [process_row(spec, val_n, **kwargs) for spec in specs]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(
+                    lambda spec: process_row_isolated(spec, val_n, **kwargs), specs
+                )
+            )
+    entries = {
+        result["dataset"]: result.pop("manifest")
+        for result in results
+        if "manifest" in result
+    }
+    if manifest_path:
+        update_datasets(entries, manifest_path)
+    summary = pd.DataFrame(results).astype(
+        {"train_rows": "Int64", "val_rows": "Int64", "output_bytes": "Int64"}
+    )
+    print(summary.to_string(index=False))
+    return summary
+
+
+def merge(dataset_items):
+    df = pd.concat(
+        [pd.read_parquet(dataset_item) for dataset_item in dataset_items],
+        ignore_index=True,
+    )
     return df
 
 
-def merge_datasets():
-    train_sets = glob.glob("train*")
-    train = merge(train_sets)
-    train.to_parquet("train.parquet")
+def merge_to_parquet(dataset_items, path, batch_size=10_000, schema=None):
+    """Merge parquet files into ``path`` out of core: each input is read in
+    batches of ``batch_size`` rows and appended to a single ParquetWriter, so
+    memory is proportional to one batch rather than to the merged output."""
+    schema = schema or merge_schema(dataset_items)
+    with pq.ParquetWriter(path, schema) as writer:
+        for dataset_item in dataset_items:
+            parquet_file = pq.ParquetFile(dataset_item)
+            columns = [
+                name for name in schema.names if name in parquet_file.schema_arrow.names
+            ]
+            for batch in parquet_file.iter_batches(
+                batch_size=batch_size, columns=columns
+            ):
+                writer.write_table(conform(pa.Table.from_batches([batch]), schema))
+
+
+def select_outputs(split, dataset_ids=None):
+    """``<split>_*.parquet`` outputs, only of ``dataset_ids`` if given."""
+    paths = sorted(glob.glob(f"{split}_*.parquet"))
+    if dataset_ids is None:
+        return paths
+    skipped = sorted({output_dataset_id(p, split) for p in paths} - set(dataset_ids))
+    if skipped:
+        print(f"warning: not merging {split} outputs of {skipped}, not in the registry")
+    return [p for p in paths if output_dataset_id(p, split) in dataset_ids]
 
-    val_sets = glob.glob("val*")
-    val = merge(val_sets)
-    val.to_parquet("val.parquet")
+
+def merge_datasets(batch_size=10_000, mixture=None, manifest_path=MANIFEST_PATH,
+                   dataset_ids=None):
+    """Merge the per-dataset outputs into train.parquet and val.parquet.
+    Train is concatenated, or with ``mixture`` (keyword arguments of
+    ``mixing.Mixture``, e.g. ``temperature`` or ``weights``) mixed. With
+    ``dataset_ids``, outputs of other datasets are left out."""
+    start = time.perf_counter()
+    train_paths = select_outputs("train", dataset_ids)
+    if mixture is None:
+        merge_to_parquet(train_paths, "train.parquet", batch_size=batch_size)
+    else:
+        mixed = Mixture(train_paths, **mixture)
+        print(mixed.report().to_string(index=False))
+        mixed.write("train.parquet", batch_size=batch_size)
+    train_seconds = round(time.perf_counter() - start, 1)
+    val_paths = select_outputs("val", dataset_ids)
+    merge_to_parquet(val_paths, "val.parquet", batch_size=batch_size)
+    if manifest_path:
+        update_merged(
+            "train.parquet",
+            train_paths,
+            manifest_path,
+            mixture=mixture,
+            seconds=train_seconds,
+        )
+        update_merged(
+            "val.parquet",
+            val_paths,
+            manifest_path,
+            seconds=round(time.perf_counter() - start - train_seconds, 1),
+        )
+
+
+def output_weights(registry_path, split="train"):
+    """Registry mixing weights of the datasets with ``<split>_*.parquet``
+    outputs here; None without a registry or weights."""
+    if not os.path.exists(registry_path):
+        return None
+    weights = registry_weights(read_registry(registry_path))
+    if weights is None:
+        return None
+    present = {output_dataset_id(p, split) for p in glob.glob(f"{split}_*.parquet")}
+    return {name: weight for name, weight in weights.items() if name in present}
+
+
+def merge_fragments(split, output_dir, batch_size=10_000, manifest_path=MANIFEST_PATH):
+    """Merge ``<split>_*.parquet`` into the parquet dataset directory
+    ``output_dir``, one fragment ``<dataset_id>.parquet`` per dataset.
+
+    The manifest records each fragment's inputs. A fragment is only
+    rewritten when an input was added, removed or changed (by footer
+    checksum), when the fragment itself changed, or when the merged schema
+    changed; fragments of datasets that are gone are deleted. Returns the
+    dataset_ids whose fragments were written."""
+    inputs = {}
+    for path in sorted(glob.glob(f"{split}_*.parquet")):
+        inputs.setdefault(output_dataset_id(path, split), []).append(path)
+    schema = merge_schema([path for paths in inputs.values() for path in paths])
+    manifest = read_manifest(manifest_path)
+    key = os.path.basename(os.path.normpath(output_dir))
+    previous = manifest["merged"].get(key, {})
+    old_fragments = previous.get("fragments", {})
+    same_schema = previous.get("schema") == schema_fields(schema)
+    os.makedirs(output_dir, exist_ok=True)
+    fragments, written = {}, []
+    for dataset_id, paths in inputs.items():
+        entries = [file_entry(path) for path in paths]
+        path = os.path.join(output_dir, f"{dataset_id}.parquet")
+        old = old_fragments.get(dataset_id)
+        if not (
+            same_schema
+            and old is not None
+            and old["inputs"] == entries
+            and unchanged(path, old["fragment"])
+        ):
+            # dot files are ignored by parquet dataset readers
+            tmp_path = os.path.join(output_dir, f".{dataset_id}.parquet.tmp")
+            merge_to_parquet(paths, tmp_path, batch_size=batch_size, schema=schema)
+            os.replace(tmp_path, path)
+            written.append(dataset_id)
+        name = os.path.join(key, f"{dataset_id}.parquet")
+        fragments[dataset_id] = {"inputs": entries, "fragment": file_entry(path, name)}
+    for dataset_id in set(old_fragments) - set(inputs):
+        path = os.path.join(output_dir, f"{dataset_id}.parquet")
+        if os.path.exists(path):
+            os.remove(path)
+    manifest["merged"][key] = {
+        "path": key,
+        "format": "parquet_dataset",
+        "num_rows": sum(f["fragment"]["num_rows"] for f in fragments.values()),
+        "schema": schema_fields(schema),
+        "fragments": fragments,
+    }
+    write_manifest(manifest, manifest_path)
+    return written
+
+
+def registry_prompts(specs):
+    """Prompt templates of all registry datasets, to strip from merged rows."""
+    templates = {}
+    for spec in specs:
+        for template in PromptSet.from_prompt(spec.prompt).templates:
+            templates.setdefault(template.template, template)
+    return list(templates.values())
+
+
+def dedup_datasets(paths, output, specs, report_path=None, workers=1, batch_size=10_000,
+                   minhash_options=None, manifest_path=MANIFEST_PATH):
+    """Drop exact and (unless ``minhash_options`` is None) near-duplicate
+    sources across the merged datasets; see dedup.py."""
+    report = dedup_parquet(
+        paths,
+        output,
+        templates=registry_prompts(specs),
+        options=minhash_options,
+        workers=workers,
+        batch_size=batch_size,
+    )
+    print(report.to_string(index=False))
+    if report_path:
+        report.to_csv(report_path, index=False)
+    if manifest_path:
+        update_merged(
+            output,
+            paths,
+            manifest_path,
+            dedup={
+                "near_duplicates": minhash_options is not None,
+                "removed_rows": int(report["rows"].sum() - report["kept"].sum()),
+            },
+        )
+    return report
+
+
+def check_leakage(train_paths, val_paths, specs, report_path=None, output=None,
+                  workers=1, batch_size=10_000, manifest_path=MANIFEST_PATH):
+    """Report validation rows that also occur in train, ignoring prompts; with
+    ``output``, also write train without them there. See leakage.py."""
+    val, leaks = find_leaks(
+        train_paths,
+        val_paths,
+        templates=registry_prompts(specs),
+        workers=workers,
+    )
+    report = leakage_report(val, leaks)
+    print(report.to_string(index=False))
+    if report_path:
+        report.to_csv(report_path, index=False)
+    if output:
+        remove_leaks(train_paths, leaks, output, batch_size)
+        print(f"removed {len(leaks)} train rows")
+        if manifest_path:
+            update_merged(
+                output,
+                train_paths,
+                manifest_path,
+                leakage={"val_paths": val_paths, "removed_rows": len(leaks)},
+            )
+    return report
+
+
+def pretokenize_outputs(paths, tokenizer_path, workers=1, batch_size=1_000,
+                        add_special_tokens=True):
+    """Tokenize merged outputs into memory-mapped arrays; see pretokenize.py."""
+    stats = []
+    for path in paths:
+        meta = pretokenize(
+            path,
+            tokenizer_path,
+            workers=workers,
+            batch_size=batch_size,
+            add_special_tokens=add_special_tokens,
+        )
+        stats.append(
+            {
+                "input": meta["input"],
+                "rows": meta["num_rows"],
+                **{f"{column}_tokens": n for column, n in meta["num_tokens"].items()},
+                "seconds": meta["seconds"],
+                "tokens_per_second": meta["tokens_per_second"],
+            }
+        )
+    stats = pd.DataFrame(stats)
+    print(stats.to_string(index=False))
+    return stats
+
+
+def pack_outputs(prefixes, source_length=1024, target_length=256):
+    """Pack pretokenized outputs into fixed-length blocks; see packing.py."""
+    stats = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        meta = pack_dataset(prefix, source_length, target_length)
+        stats.append(
+            {
+                "input": prefix,
+                "examples": meta["num_examples"],
+                "blocks": meta["num_blocks"],
+                "truncated": meta["truncated_examples"],
+                **{
+                    f"{column}_efficiency_{when}": round(efficiency, 3)
+                    for when in ["before", "after"]
+                    for column, efficiency in meta[f"efficiency_{when}"].items()
+                },
+                "seconds": round(time.perf_counter() - start, 2),
+            }
+        )
+    stats = pd.DataFrame(stats)
+    print(stats.to_string(index=False))
+    return stats
 
 
 if __name__ == "__main__":
-    # df = pd.read_csv("hf_datasets.csv")
-    # process_datasets(df)
-    merge_datasets()
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+
+    process_parser = subparsers.add_parser("process")
+    process_parser.add_argument("--registry", default="hf_datasets.csv")
+    process_parser.add_argument("--val_n", type=int, default=100)
+    process_parser.add_argument("--workers", type=int, default=1)
+    process_parser.add_argument(
+        "--num_proc", type=int, default=1, help="processes for batch transforms"
+    )
+    process_parser.add_argument("--arrow", action="store_true")
+    process_parser.add_argument("--streaming", action="store_true")
+    process_parser.add_argument("--seed", type=int, default=0)
+    process_parser.add_argument(
+        "--split_key", default="content", choices=["content", "index"]
+    )
+    process_parser.add_argument(
+        "--cache", action="store_true", help="reuse outputs of unchanged datasets"
+    )
+    process_parser.add_argument("--cache_dir", default=None)
+    process_parser.add_argument("--max_rows_per_shard", type=int, default=None)
+    process_parser.add_argument("--max_bytes_per_shard", type=int, default=None)
+    process_parser.add_argument("--row_group_size", type=int, default=None)
+    process_parser.add_argument(
+        "--compression", default="snappy", choices=["snappy", "zstd", "lz4", "gzip", "none"]
+    )
+    process_parser.add_argument("--no_dictionary", action="store_true")
+    process_parser.add_argument(
+        "--output_format", default="parquet", choices=["parquet", "jsonl"]
+    )
+    process_parser.add_argument(
+        "--jsonl_compression", default=None, choices=["gzip", "zstd"]
+    )
+    process_parser.add_argument(
+        "--tokenizer",
+        default=None,
+        help="saved fast tokenizer; enables token length statistics",
+    )
+    process_parser.add_argument("--max_source_tokens", type=int, default=None)
+    process_parser.add_argument("--max_target_tokens", type=int, default=None)
+    process_parser.add_argument(
+        "--length_policy", default="none", choices=["none", "filter", "truncate"]
+    )
+    process_parser.add_argument(
+        "--metrics",
+        default=None,
+        help="append per-stage timing and memory of each dataset to this file",
+    )
+
+    merge_parser = subparsers.add_parser("merge")
+    merge_parser.add_argument("--batch_size", type=int, default=10_000)
+    merge_parser.add_argument(
+        "--mix", action="store_true", help="mix train instead of concatenating it"
+    )
+    merge_parser.add_argument(
+        "--weights",
+        nargs="+",
+        default=None,
+        metavar="DATASET_ID=WEIGHT",
+        help="explicit mixing weights, one per dataset",
+    )
+    merge_parser.add_argument(
+        "--registry",
+        default="hf_datasets.csv",
+        help="mixing weights of its weight column, unless --weights is given",
+    )
+    merge_parser.add_argument("--temperature", type=float, default=1.0)
+    merge_parser.add_argument(
+        "--cap", type=int, default=None, help="examples-proportional rate limit"
+    )
+    merge_parser.add_argument("--num_rows", type=int, default=None)
+    merge_parser.add_argument("--seed", type=int, default=0)
+    merge_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="merge into train/ and val/ directories of per-dataset fragments, "
+        "rewriting only the fragments of changed datasets",
+    )
+
+    dedup_parser = subparsers.add_parser("dedup")
+    dedup_parser.add_argument("--input", nargs="+", default=["train.parquet"])
+    dedup_parser.add_argument("--output", default="train.parquet")
+    dedup_parser.add_argument("--registry", default="hf_datasets.csv")
+    dedup_parser.add_argument("--report", default="dedup_report.csv")
+    dedup_parser.add_argument("--workers", type=int, default=1)
+    dedup_parser.add_argument("--batch_size", type=int, default=10_000)
+    dedup_parser.add_argument(
+        "--exact_only", action="store_true", help="skip MinHash near duplicates"
+    )
+    dedup_parser.add_argument("--num_bands", type=int, default=16)
+    dedup_parser.add_argument("--band_rows", type=int, default=8)
+    dedup_parser.add_argument("--shingle_words", type=int, default=5)
+
+    leakage_parser = subparsers.add_parser("leakage")
+    leakage_parser.add_argument("--train", nargs="+", default=["train.parquet"])
+    leakage_parser.add_argument(
+        "--val", nargs="+", default=None, help="default: val_*.parquet"
+    )
+    leakage_parser.add_argument("--registry", default="hf_datasets.csv")
+    leakage_parser.add_argument("--report", default="leakage_report.csv")
+    leakage_parser.add_argument(
+        "--remove", action="store_true", help="drop leaked rows from train"
+    )
+    leakage_parser.add_argument("--output", default="train.parquet")
+    leakage_parser.add_argument("--workers", type=int, default=1)
+    leakage_parser.add_argument("--batch_size", type=int, default=10_000)
+
+    pretokenize_parser = subparsers.add_parser("pretokenize")
+    pretokenize_parser.add_argument(
+        "--tokenizer", required=True, help="directory of a saved fast tokenizer"
+    )
+    pretokenize_parser.add_argument(
+        "--input", nargs="+", default=["train.parquet", "val.parquet"]
+    )
+    pretokenize_parser.add_argument("--workers", type=int, default=1)
+    pretokenize_parser.add_argument("--batch_size", type=int, default=1_000)
+    pretokenize_parser.add_argument("--no_special_tokens", action="store_true")
+
+    pack_parser = subparsers.add_parser("pack")
+    pack_parser.add_argument(
+        "--input", nargs="+", default=["train"], help="pretokenized output prefixes"
+    )
+    pack_parser.add_argument("--source_length", type=int, default=1024)
+    pack_parser.add_argument("--target_length", type=int, default=256)
+
+    subparsers.add_parser("lengths")
+
+    manifest_parser = subparsers.add_parser("manifest")
+    manifest_parser.add_argument("--manifest", default=MANIFEST_PATH)
+    manifest_parser.add_argument(
+        "--deep", action="store_true", help="also hash whole non-parquet files"
+    )
+
+    registry_parser = subparsers.add_parser("registry")
+    registry_parser.add_argument("--registry", default="hf_datasets.csv")
+
+    cache_parser = subparsers.add_parser("cache")
+    cache_parser.add_argument("action", choices=["list", "evict"])
+    cache_parser.add_argument("--cache_dir", default=None)
+    cache_parser.add_argument("--max_age_days", type=float, default=None)
+    cache_parser.add_argument("--max_size_gb", type=float, default=None)
+
+    args = parser.parse_args()
+    if args.command == "process":
+        process_datasets(
+            read_registry(args.registry, check_paths=True),
+            val_n=args.val_n,
+            workers=args.workers,
+            arrow=args.arrow,
+            streaming=args.streaming,
+            seed=args.seed,
+            split_key=args.split_key,
+            cache=ProcessingCache(args.cache_dir) if args.cache else None,
+            parquet_options=ParquetOptions(
+                max_rows_per_shard=args.max_rows_per_shard,
+                max_bytes_per_shard=args.max_bytes_per_shard,
+                row_group_size=args.row_group_size,
+                compression=args.compression,
+                use_dictionary=not args.no_dictionary,
+            ),
+            output_format=args.output_format,
+            jsonl_compression=args.jsonl_compression,
+            length_policy=LengthPolicy(
+                tokenizer=args.tokenizer,
+                max_source_tokens=args.max_source_tokens,
+                max_target_tokens=args.max_target_tokens,
+                action=args.length_policy,
+            )
+            if args.tokenizer
+            else None,
+            metrics_path=args.metrics,
+            num_proc=args.num_proc,
+        )
+    elif args.command == "dedup":
+        dedup_datasets(
+            args.input,
+            args.output,
+            read_registry(args.registry),
+            report_path=args.report,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            minhash_options=None
+            if args.exact_only
+            else MinHashOptions(
+                num_bands=args.num_bands,
+                band_rows=args.band_rows,
+                shingle_words=args.shingle_words,
+            ),
+        )
+    elif args.command == "leakage":
+        check_leakage(
+            args.train,
+            args.val or sorted(glob.glob("val_*.parquet")),
+            read_registry(args.registry),
+            report_path=args.report,
+            output=args.output if args.remove else None,
+            workers=args.workers,
+            batch_size=args.batch_size,
+        )
+    elif args.command == "pretokenize":
+        pretokenize_outputs(
+            args.input,
+            args.tokenizer,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            add_special_tokens=not args.no_special_tokens,
+        )
+    elif args.command == "pack":
+        pack_outputs(args.input, args.source_length, args.target_length)
+    elif args.command == "manifest":
+        start = time.perf_counter()
+        files = validate_manifest(args.manifest, deep=args.deep)
+        print(files.to_string(index=False))
+        problems = files[files["status"] != "ok"]
+        print(
+            f"{len(files)} files, {len(problems)} problems, "
+            f"validated in {(time.perf_counter() - start) * 1000:.1f} ms"
+        )
+        if len(problems):
+            raise SystemExit(1)
+    elif args.command == "registry":
+        specs = read_registry(args.registry, check_paths=True)
+        print(registry_table(specs).to_string(index=False))
+        print(f"{len(specs)} datasets, registry is valid")
+    elif args.command == "lengths":
+        stats = read_length_stats(sorted(glob.glob("train_*.lengths.json")))
+        print(stats.to_string(index=False))
+    elif args.command == "cache":
+        cache = ProcessingCache(args.cache_dir)
+        if args.action == "evict":
+            evicted = cache.evict(
+                max_age_days=args.max_age_days,
+                max_bytes=None
+                if args.max_size_gb is None
+                else int(args.max_size_gb * 1024**3),
+            )
+            print(f"evicted {len(evicted)} entries")
+        entries = cache.entries()
+        print(entries.to_string(index=False))
+        print(f"{len(entries)} entries, {entries['bytes'].sum() / 1024**2:.1f} MB")
+    else:
+        mixture, dataset_ids = None, None
+        if getattr(args, "mix", False) or getattr(args, "weights", None):
+            if args.weights is None:
+                weights = output_weights(args.registry)
+                # registry weights: outputs of datasets not in it are left out
+                dataset_ids = None if weights is None else set(weights)
+            else:
+                weights = {
+                    name: float(weight)
+                    for name, weight in (item.split("=") for item in args.weights)
+                }
+            mixture = dict(
+                weights=weights,
+                temperature=args.temperature,
+                cap=args.cap,
+                num_rows=args.num_rows,
+                seed=args.seed,
+            )
+        if getattr(args, "incremental", False):
+            if mixture is not None:
+                parser.error("--incremental merges cannot be mixed")
+            for split in ["train", "val"]:
+                start = time.perf_counter()
+                written = merge_fragments(split, split, batch_size=args.batch_size)
+                print(
+                    f"{split}: rewrote {len(written)} fragments {written} "
+                    f"in {time.perf_counter() - start:.1f}s"
+                )
+        else:
+            merge_datasets(
+                batch_size=getattr(args, "batch_size", 10_000),
+                mixture=mixture,
+                dataset_ids=dataset_ids,
+            )
 
 
     # xsum = {
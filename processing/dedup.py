@@ -0,0 +1,334 @@
+"""Exact and near-duplicate removal for merged parquet outputs.
+
+Rows are compared on their normalized source: prompt text stripped (see
+``prompts.strip_prompts``), lowercased, punctuation removed and whitespace
+collapsed. Exact duplicates share the hash of that word sequence. Near
+duplicates are found with MinHash-LSH over word shingles (signatures use
+one permutation hashing, see ``band_keys``): each row's signature is cut
+into ``num_bands`` bands of ``band_rows`` values, and rows sharing any band
+are treated as duplicates (pairs with Jaccard similarity above roughly
+``MinHashOptions.threshold`` collide in at least one band).
+
+Signatures are computed in worker processes, one parquet row group at a
+time. The parent keeps 8 bytes per row for the exact hashes and spills the
+band keys to a memory-mapped file, then groups one band at a time, so
+memory stays at a few tens of bytes per row however many bands are used.
+Of every group of duplicates the first row (in input order) is kept.
+"""
+import functools
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from prompts import strip_prompts
+from sampling import hash_key
+
+EMPTY = np.iinfo(np.uint64).max
+PRIME = np.uint64(0x100000001B3)
+
+
+@dataclass
+class MinHashOptions:
+    num_bands: int = 16
+    band_rows: int = 8
+    shingle_words: int = 5
+    seed: int = 0
+
+    @property
+    def num_perm(self):
+        return self.num_bands * self.band_rows
+
+    @property
+    def threshold(self):
+        """Jaccard similarity at which a pair collides with probability ~1/2."""
+        return (1 / self.num_bands) ** (1 / self.band_rows)
+
+    def hash_params(self):
+        rng = np.random.default_rng(self.seed)
+        # odd multipliers, so multiplying permutes the 64-bit hashes
+        a, b = rng.integers(0, 2**63, 2, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        band_coefs = rng.integers(0, 2**63, self.band_rows, dtype=np.uint64)
+        return a, b, band_coefs * np.uint64(2) + np.uint64(1)
+
+
+def normalized_words(source, templates=()):
+    """Lowercased words of ``source`` with the prompts of ``templates``
+    stripped; punctuation and symbols separate words."""
+    if templates:
+        source = strip_prompts(source, templates)
+    source = pc.utf8_lower(source)
+    source = pc.replace_substring_regex(source, r"[^\pL\pN\s]+", " ")
+    # splitting untrimmed text yields empty words at either end
+    return pc.utf8_split_whitespace(pc.utf8_trim_whitespace(source))
+
+
+def word_hashes(words, seed=0):
+    """Hash of every word, flattened over rows, and the number of words of
+    each row. Each distinct word is hashed once."""
+    if isinstance(words, pa.ChunkedArray):
+        words = words.combine_chunks()
+    lengths = pc.fill_null(pc.list_value_length(words), 0).to_numpy().astype(np.int64)
+    encoded = pc.list_flatten(words).dictionary_encode()
+    vocabulary = encoded.dictionary.to_numpy(zero_copy_only=False)
+    hashes = pd.util.hash_array(vocabulary, hash_key=hash_key(seed))
+    return hashes[encoded.indices.to_numpy()], lengths
+
+
+def exact_hashes(hashes, lengths):
+    """Polynomial hash of each row's word sequence; 0 for empty rows."""
+    starts = np.cumsum(lengths) - lengths
+    position = np.arange(len(hashes)) - np.repeat(starts, lengths)
+    powers = np.cumprod(np.full(max(lengths.max(initial=0), 1), PRIME))
+    result = np.zeros(len(lengths), dtype=np.uint64)
+    nonempty = lengths > 0
+    if nonempty.any():
+        terms = hashes * powers[position]
+        result[nonempty] = np.add.reduceat(terms, starts[nonempty])
+    return result
+
+
+def shingle_hashes(hashes, lengths, shingle_words=5):
+    """Hash of every ``shingle_words``-word shingle, flattened over rows, and
+    the number of shingles of each row. Rows shorter than a shingle get one
+    shingle of all their words; empty rows get none."""
+    counts = np.where(lengths > 0, np.maximum(lengths - shingle_words + 1, 1), 0)
+    word_starts = np.cumsum(lengths) - lengths
+    shingle_starts = np.cumsum(counts) - counts
+    total = int(counts.sum())
+    shingles = np.zeros(total, dtype=np.uint64)
+    if total == 0:
+        return shingles, counts
+    # position of each shingle's first word in the flattened words
+    first = np.arange(total) + np.repeat(word_starts - shingle_starts, counts)
+    end = np.repeat(word_starts + lengths, counts)
+    for j in range(shingle_words):
+        position = first + j
+        word = hashes[np.minimum(position, len(hashes) - 1)]
+        shingles = (shingles ^ np.where(position < end, word, 0)) * PRIME
+    return shingles, counts
+
+
+def densify(signatures):
+    """Fill empty bins with the next non-empty bin to the right (wrapping
+    around), offset by the distance so copies differ from their source.
+    Rows without any shingle stay EMPTY."""
+    num_perm = signatures.shape[1]
+    doubled = np.concatenate([signatures, signatures], axis=1)
+    index = np.where(doubled != EMPTY, np.arange(2 * num_perm), 2 * num_perm - 1)
+    source = np.minimum.accumulate(index[:, ::-1], axis=1)[:, ::-1][:, :num_perm]
+    distance = (source - np.arange(num_perm)).astype(np.uint64)
+    dense = np.take_along_axis(doubled, source, axis=1) + distance * PRIME
+    dense[(signatures == EMPTY).all(axis=1)] = EMPTY
+    return dense
+
+
+def band_keys(hashes, lengths, options):
+    """``(rows, num_bands)`` uint64 LSH keys of rows given as ``word_hashes``,
+    and a mask of empty rows.
+
+    Signatures use one permutation hashing: each shingle hash is permuted
+    once and lands in one of ``num_perm`` bins by its residue, keeping the
+    minimum per bin. That costs O(shingles) instead of O(shingles *
+    num_perm) for one permutation per signature value.
+    """
+    shingles, counts = shingle_hashes(hashes, lengths, options.shingle_words)
+    a, b, band_coefs = options.hash_params()
+    permuted = shingles * a + b
+    rows = np.repeat(np.arange(len(counts)), counts)
+    bins = (permuted % np.uint64(options.num_perm)).astype(np.int64)
+    signatures = np.full((len(counts), options.num_perm), EMPTY, dtype=np.uint64)
+    np.minimum.at(signatures.reshape(-1), rows * options.num_perm + bins, permuted)
+    bands = densify(signatures).reshape(len(counts), options.num_bands, -1)
+    keys = (bands * band_coefs).sum(axis=2, dtype=np.uint64)
+    return keys, counts == 0
+
+
+def row_group_keys(path, row_group, column, templates, options, batch_size):
+    """Exact hashes, band keys (None when ``options`` is None), empty mask and
+    dictionary-encoded dataset_id of one row group."""
+    parquet_file = pq.ParquetFile(path)
+    columns = [column]
+    if "dataset_id" in parquet_file.schema_arrow.names:
+        columns.append("dataset_id")
+    exact, keys, empty, ids = [], [], [], []
+    for batch in parquet_file.iter_batches(
+        batch_size=batch_size, row_groups=[row_group], columns=columns
+    ):
+        hashes, lengths = word_hashes(normalized_words(batch[column], templates))
+        exact.append(exact_hashes(hashes, lengths))
+        if options is not None:
+            batch_keys, batch_empty = band_keys(hashes, lengths, options)
+            keys.append(batch_keys)
+            empty.append(batch_empty)
+        if "dataset_id" in columns:
+            ids.append(pc.cast(batch["dataset_id"], pa.string()))
+        else:
+            ids.append(pa.nulls(batch.num_rows, pa.string()))
+    ids = pa.chunked_array(ids, pa.string()).combine_chunks().dictionary_encode()
+    return (
+        np.concatenate(exact) if exact else np.empty(0, dtype=np.uint64),
+        np.concatenate(keys) if keys else None,
+        np.concatenate(empty) if empty else None,
+        pc.fill_null(ids.indices, -1).to_numpy(),
+        ids.dictionary.to_pylist(),
+    )
+
+
+def group_edges(keys, mask=None):
+    """(row, first row) for every row whose key an earlier row shares."""
+    rows = np.arange(len(keys)) if mask is None else np.flatnonzero(mask)
+    keys = keys if mask is None else keys[rows]
+    if len(keys) == 0:
+        return rows, rows
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    new_group = np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]])
+    firsts = order[np.flatnonzero(new_group)]
+    first = np.repeat(firsts, np.diff(np.append(np.flatnonzero(new_group), len(keys))))
+    duplicate = ~new_group
+    return rows[order[duplicate]], rows[first[duplicate]]
+
+
+def component_firsts(num_rows, edges):
+    """For each row, the first row of its connected component."""
+    labels = np.arange(num_rows)
+    if not edges:
+        return labels
+    rows = np.concatenate([r for r, _ in edges])
+    firsts = np.concatenate([f for _, f in edges])
+    while True:
+        previous = labels.copy()
+        np.minimum.at(labels, rows, labels[firsts])
+        np.minimum.at(labels, firsts, labels[rows])
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def find_duplicates(paths, column="source", templates=(), options=None, workers=1,
+                    batch_size=10_000):
+    """Scan ``paths`` and return a DataFrame with, per row, ``dataset_id``,
+    ``kept`` and ``duplicate`` ("exact", "near" or None) and the ``dataset_id``
+    of the kept row it duplicates. ``options=None`` skips near duplicates."""
+    tasks = [
+        (path, i)
+        for path in paths
+        for i in range(pq.ParquetFile(path).num_row_groups)
+    ]
+    num_rows = sum(pq.read_metadata(path).num_rows for path in paths)
+    exact = np.empty(num_rows, dtype=np.uint64)
+    empty = np.zeros(num_rows, dtype=bool)
+    codes = np.empty(num_rows, dtype=np.int32)
+    names = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        keys = None
+        if options is not None:
+            # band-major, so each band is a contiguous read
+            keys = np.lib.format.open_memmap(
+                os.path.join(tmp_dir, "band_keys.npy"),
+                mode="w+",
+                dtype=np.uint64,
+                shape=(options.num_bands, num_rows),
+            )
+        scan = functools.partial(
+            row_group_keys,
+            column=column,
+            templates=templates,
+            options=options,
+            batch_size=batch_size,
+        )
+        task_paths, task_groups = [p for p, _ in tasks], [i for _, i in tasks]
+        # no worker processes are started unless the executor's map is used
+        with ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+            results = (executor.map if workers > 1 else map)(
+                scan, task_paths, task_groups
+            )
+            offset = 0
+            for group_exact, group_keys, group_empty, indices, dictionary in results:
+                if not len(group_exact):
+                    continue
+                end = offset + len(group_exact)
+                exact[offset:end] = group_exact
+                if keys is not None:
+                    keys[:, offset:end] = group_keys.T
+                    empty[offset:end] = group_empty
+                local = np.array(
+                    [names.setdefault(name, len(names)) for name in dictionary] + [-1],
+                    dtype=np.int32,
+                )
+                codes[offset:end] = local[indices]
+                offset = end
+        exact_rows, exact_firsts = group_edges(exact)
+        edges = [(exact_rows, exact_firsts)]
+        if keys is not None:
+            for band in range(options.num_bands):
+                edges.append(group_edges(np.asarray(keys[band]), ~empty))
+            del keys
+    labels = component_firsts(num_rows, edges)
+    kept = labels == np.arange(num_rows)
+    duplicate = np.where(kept, -1, 1)
+    duplicate[exact_rows] = 0
+    # categoricals: a few bytes per row rather than an object per row
+    return pd.DataFrame(
+        {
+            "dataset_id": pd.Categorical.from_codes(codes, list(names)),
+            "kept": kept,
+            "duplicate": pd.Categorical.from_codes(duplicate, ["exact", "near"]),
+            "duplicate_of": pd.Categorical.from_codes(
+                np.where(kept, -1, codes[labels]), list(names)
+            ),
+        }
+    )
+
+
+def dedup_report(rows):
+    """Per dataset_id counts of rows removed as exact and near duplicates,
+    and of those, how many duplicate a row kept from another dataset."""
+    rows = rows.assign(
+        exact=rows["duplicate"] == "exact",
+        near=rows["duplicate"] == "near",
+        cross_dataset=~rows["kept"]
+        & (rows["duplicate_of"].cat.codes != rows["dataset_id"].cat.codes),
+    )
+    report = rows.groupby("dataset_id", dropna=False, observed=True).agg(
+        rows=("kept", "size"),
+        kept=("kept", "sum"),
+        exact_duplicates=("exact", "sum"),
+        near_duplicates=("near", "sum"),
+        cross_dataset=("cross_dataset", "sum"),
+    )
+    report["removed_pct"] = (100 * (1 - report["kept"] / report["rows"])).round(2)
+    return report.reset_index()
+
+
+def write_filtered(paths, keep, output, batch_size=10_000):
+    """Write the rows of ``paths`` where ``keep`` is set to ``output``. The
+    output may be one of the inputs: it is written to a temporary file first.
+    The inputs are expected to share a schema, e.g. shards of one output."""
+    tmp_path = output + ".tmp"
+    schema = pq.read_schema(paths[0])
+    offset = 0
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for path in paths:
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+                table = pa.Table.from_batches([batch]).cast(schema)
+                mask = keep[offset : offset + table.num_rows]
+                writer.write_table(table.filter(pa.array(mask)))
+                offset += table.num_rows
+    os.replace(tmp_path, output)
+
+
+def dedup_parquet(paths, output, column="source", templates=(), options=None,
+                  workers=1, batch_size=10_000):
+    """Remove duplicates from ``paths`` (in that order) into ``output`` and
+    return the per dataset_id report."""
+    rows = find_duplicates(paths, column, templates, options, workers, batch_size)
+    write_filtered(paths, rows["kept"].to_numpy(), output, batch_size)
+    return dedup_report(rows)
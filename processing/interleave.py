@@ -0,0 +1,232 @@
+"""Read the per-dataset outputs as one dataset, without merging them.
+
+``InterleavedReader`` opens every ``train_<name>.parquet`` (or its shards)
+written by ``save_format``, memory-mapped, and yields their rows
+interleaved on the fly, so adding a dataset to hf_datasets.csv does not
+mean rewriting a merged train.parquet. Rows are interleaved
+
+* ``"round_robin"``: one row of each dataset in turn, skipping datasets
+  that have run out;
+* ``"weighted"``: each row from a dataset drawn with probability
+  proportional to its weight (by default its size) among the datasets
+  that have rows left;
+* ``"shuffle"``: row groups of all datasets in a random order (each
+  dataset spread over the pass), streamed through a shuffle buffer of
+  ``buffer_size`` rows.
+
+Every row is read once per pass; see mixing.py for up- and downsampling.
+Batches are assembled from the row groups currently being read, one per
+dataset (``shuffle`` holds the buffer instead).
+
+``reader[i]`` and ``reader.take(indices)`` index the datasets concatenated
+in ``dataset_id`` order: the row group holding row ``i`` is found by a
+binary search over the row group offsets, i.e. in O(log row groups).
+"""
+import glob
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from mixing import mixture_rates, row_groups
+from writers import conform, merge_schema
+
+MODES = ["round_robin", "weighted", "shuffle"]
+
+
+class InterleavedReader:
+    def __init__(self, paths=None, mode="round_robin", weights=None, seed=0,
+                 buffer_size=100_000, columns=None, split="train", cache_size=4):
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}")
+        if paths is None:
+            paths = glob.glob(f"{split}_*.parquet")
+        self.mode = mode
+        self.seed = seed
+        self.buffer_size = buffer_size
+        self.groups = row_groups(paths, split)
+        self.names = sorted(self.groups)
+        # (path, row group, rows) of all datasets, concatenated
+        self.units = [unit for name in self.names for unit in self.groups[name]]
+        self.unit_starts = np.cumsum([0] + [rows for _, _, rows in self.units])
+        first_units = np.cumsum([0] + [len(self.groups[name]) for name in self.names])
+        self.dataset_units = dict(zip(self.names, zip(first_units, first_units[1:])))
+        self.sizes = np.array(
+            [sum(rows for _, _, rows in self.groups[name]) for name in self.names]
+        )
+        if mode == "weighted":
+            sizes = pd.Series(self.sizes, index=self.names)
+            self.rates = mixture_rates(sizes, weights).to_numpy()
+        self.schema = merge_schema(paths)
+        if columns is not None:
+            self.schema = pa.schema([self.schema.field(c) for c in columns])
+        self.files = {}
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return int(self.unit_starts[-1])
+
+    def open(self, path):
+        if path not in self.files:
+            self.files[path] = pq.ParquetFile(pa.memory_map(path))
+        return self.files[path]
+
+    def read_unit(self, unit):
+        """Row group ``unit`` of ``units``, conformed to the merged schema;
+        the last ``cache_size`` row groups read are kept."""
+        if unit not in self.cache:
+            path, row_group, _ = self.units[unit]
+            parquet_file = self.open(path)
+            names = parquet_file.schema_arrow.names
+            table = parquet_file.read_row_group(
+                row_group, columns=[c for c in self.schema.names if c in names]
+            )
+            if len(self.cache) >= self.cache_size:
+                del self.cache[next(iter(self.cache))]
+            self.cache[unit] = conform(table, self.schema)
+        return self.cache[unit]
+
+    def locate(self, indices):
+        """(row group, row within it) of global row ``indices``."""
+        indices = np.asarray(indices)
+        if ((indices < 0) | (indices >= len(self))).any():
+            raise IndexError("row index out of range")
+        units = np.searchsorted(self.unit_starts, indices, side="right") - 1
+        return units, indices - self.unit_starts[units]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        units, rows = self.locate([i])
+        return self.read_unit(int(units[0])).slice(int(rows[0]), 1).to_pylist()[0]
+
+    def take(self, indices):
+        """Rows ``indices`` as a table, in that order."""
+        units, rows = self.locate(indices)
+        order = np.argsort(units, kind="stable")
+        tables = []
+        bounds = np.flatnonzero(np.diff(units[order])) + 1
+        for part in np.split(order, bounds) if len(order) else []:
+            tables.append(self.read_unit(int(units[part[0]])).take(rows[part]))
+        if not tables:
+            return self.schema.empty_table()
+        return pa.concat_tables(tables).take(np.argsort(order, kind="stable"))
+
+    def dataset_rows(self, name):
+        """Stream of the rows of one dataset, in order, as tables."""
+        first, end = self.dataset_units[name]
+        for unit in range(first, end):
+            path, row_group, _ = self.units[unit]
+            parquet_file = self.open(path)
+            names = parquet_file.schema_arrow.names
+            yield conform(
+                parquet_file.read_row_group(
+                    row_group, columns=[c for c in self.schema.names if c in names]
+                ),
+                self.schema,
+            )
+
+    def labels(self, batch_size, rng):
+        """Dataset of each interleaved row, ``batch_size`` rows at a time."""
+        remaining = self.sizes.copy()
+        while remaining.any():
+            active = np.flatnonzero(remaining)
+            if self.mode == "round_robin":
+                rounds = -(-batch_size // len(active))
+                labels = np.tile(active, min(int(remaining[active].min()), rounds))
+            else:
+                rates = self.rates[active]
+                if rates.sum() == 0:
+                    rates = np.ones(len(active))
+                labels = rng.choice(active, batch_size, p=rates / rates.sum())
+                # stop where the first dataset runs out, then redraw
+                counts = np.cumsum(labels[:, None] == active, axis=0)
+                over = np.flatnonzero((counts > remaining[active]).any(axis=1))
+                if len(over):
+                    labels = labels[: over[0]]
+            remaining -= np.bincount(labels, minlength=len(remaining))
+            yield labels
+
+    def interleave(self, batch_size, rng):
+        streams = [DatasetStream(self.dataset_rows(name)) for name in self.names]
+        pending = np.empty(0, dtype=np.int64)
+        for labels in self.labels(batch_size, rng):
+            pending = np.append(pending, labels)
+            while len(pending) >= batch_size:
+                yield assemble(streams, pending[:batch_size])
+                pending = pending[batch_size:]
+        if len(pending):
+            yield assemble(streams, pending)
+
+    def unit_order(self, rng):
+        """Row groups in a random order that spreads every dataset over the
+        whole pass: each dataset's row groups are shuffled and placed at the
+        fraction of the dataset read so far, plus jitter."""
+        keys = np.empty(len(self.units))
+        for name in self.names:
+            first, end = self.dataset_units[name]
+            units = first + rng.permutation(end - first)
+            rows = np.array([self.units[unit][2] for unit in units], dtype=float)
+            done = np.cumsum(rows) - rows
+            keys[units] = (done + rows * rng.random(len(units))) / max(rows.sum(), 1)
+        return np.argsort(keys, kind="stable")
+
+    def shuffled(self, batch_size, rng):
+        buffer = self.schema.empty_table()
+        units = self.unit_order(rng)
+        for i, unit in enumerate(units):
+            buffer = pa.concat_tables([buffer, self.read_unit(int(unit))])
+            last = i == len(units) - 1
+            if len(buffer) < self.buffer_size + batch_size and not last:
+                continue
+            buffer = buffer.take(rng.permutation(len(buffer)))
+            keep = 0 if last else self.buffer_size
+            for start in range(0, len(buffer) - keep, batch_size):
+                yield buffer.slice(start, min(batch_size, len(buffer) - keep - start))
+            buffer = buffer.slice(len(buffer) - keep)
+
+    def iter_batches(self, batch_size=1_000, epoch=0):
+        """Yield one pass over all rows, interleaved, as tables of up to
+        ``batch_size`` rows. The order depends on ``seed`` and ``epoch``."""
+        rng = np.random.default_rng([self.seed, epoch])
+        if self.mode == "shuffle":
+            yield from self.shuffled(batch_size, rng)
+        else:
+            yield from self.interleave(batch_size, rng)
+
+    def __iter__(self):
+        for table in self.iter_batches():
+            yield from table.to_pylist()
+
+
+class DatasetStream:
+    """Takes rows in order from a stream of tables."""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.current = None
+        self.position = 0
+
+    def take(self, n):
+        parts = []
+        while n > 0:
+            if self.current is None or self.position == len(self.current):
+                self.current = next(self.tables)
+                self.position = 0
+            part = self.current.slice(self.position, n)
+            self.position += len(part)
+            n -= len(part)
+            parts.append(part)
+        return parts
+
+
+def assemble(streams, labels):
+    """Table of the next rows of ``streams`` in the order of ``labels``."""
+    present, counts = np.unique(labels, return_counts=True)
+    table = pa.concat_tables(
+        [part for label, n in zip(present, counts) for part in streams[label].take(n)]
+    )
+    # rows are grouped by dataset in the table; put them in label order
+    return table.take(np.argsort(np.argsort(labels, kind="stable")))
@@ -0,0 +1,150 @@
+"""Train/validation leakage check.
+
+A validation row leaks when train holds the same (source, target) pair,
+compared as in dedup.py: prompts stripped, lowercased, punctuation removed.
+Rows of different datasets (and so different prompts) can therefore match.
+
+Validation is small, so its pairs are hashed into a sorted uint64 index.
+Train is scanned one row group at a time, in worker processes, reading only
+the target column: each target is squashed to its lowercased letters and
+digits and looked up among the squashed validation targets with Arrow's
+``is_in``. Only the few candidate rows have their source read and
+normalized and the full pair compared.
+"""
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from dedup import PRIME, exact_hashes, normalized_words, word_hashes, write_filtered
+
+
+def squash(targets):
+    """Lowercased letters and digits of each target. Targets that normalize
+    to the same words squash to the same string."""
+    # cheaper than one regex over all separators: the spaces are literal
+    kept = pc.replace_substring_regex(pc.utf8_lower(targets), r"[^\pL\pN ]+", "")
+    return pc.fill_null(pc.replace_substring(kept, " ", ""), "")
+
+
+def pair_keys(sources, targets, templates=()):
+    source_hashes = exact_hashes(*word_hashes(normalized_words(sources, templates)))
+    target_hashes = exact_hashes(*word_hashes(normalized_words(targets)))
+    return source_hashes * PRIME ^ target_hashes
+
+
+def dataset_ids(table, default):
+    if "dataset_id" in table.column_names:
+        return pc.cast(table["dataset_id"], pa.string()).to_numpy(zero_copy_only=False)
+    return np.full(table.num_rows, default, dtype=object)
+
+
+def val_index(paths, templates=(), source="source", target="target"):
+    """One row per validation row: its dataset_id, squashed target and pair
+    key. Rows without a dataset_id column are labelled with their file name."""
+    frames = []
+    for path in paths:
+        table = pq.read_table(path)
+        frames.append(
+            pd.DataFrame(
+                {
+                    "dataset_id": dataset_ids(table, os.path.basename(path)),
+                    "target": squash(table[target]).to_pylist(),
+                    "pair_key": pair_keys(table[source], table[target], templates),
+                }
+            )
+        )
+    columns = ["dataset_id", "target", "pair_key"]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+
+def scan_row_group(path, row_group, index_targets, index_pairs, templates, source,
+                   target):
+    """Rows of one row group whose pair is in the index, as (row numbers within
+    the row group, pair keys, dataset_ids)."""
+    parquet_file = pq.ParquetFile(path)
+    targets = parquet_file.read_row_group(row_group, columns=[target])[target]
+    candidates = pc.indices_nonzero(pc.is_in(squash(targets), value_set=index_targets))
+    if len(candidates) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64), []
+    columns = [source, target]
+    if "dataset_id" in parquet_file.schema_arrow.names:
+        columns.append("dataset_id")
+    table = parquet_file.read_row_group(row_group, columns=columns).take(candidates)
+    pairs = pair_keys(table[source], table[target], templates)
+    leaked = np.isin(pairs, index_pairs)
+    rows = candidates.to_numpy().astype(np.int64)
+    return rows[leaked], pairs[leaked], list(dataset_ids(table, None)[leaked])
+
+
+def find_leaks(train_paths, val_paths, templates=(), workers=1, source="source",
+               target="target"):
+    """Returns the validation index and a DataFrame of the leaked train rows:
+    global ``row`` number over ``train_paths``, ``pair_key`` and
+    ``dataset_id``."""
+    val = val_index(val_paths, templates, source, target)
+    index_targets = pa.array(val["target"].unique(), pa.string())
+    index_pairs = np.unique(val["pair_key"].to_numpy(dtype=np.uint64))
+    tasks, offsets = [], []
+    offset = 0
+    for path in train_paths:
+        metadata = pq.read_metadata(path)
+        for i in range(metadata.num_row_groups):
+            tasks.append((path, i))
+            offsets.append(offset)
+            offset += metadata.row_group(i).num_rows
+    scan = functools.partial(
+        scan_row_group,
+        index_targets=index_targets,
+        index_pairs=index_pairs,
+        templates=templates,
+        source=source,
+        target=target,
+    )
+    rows, pairs, ids = [], [], []
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+        results = (executor.map if workers > 1 else map)(
+            scan, [p for p, _ in tasks], [i for _, i in tasks]
+        )
+        for group_offset, (group_rows, group_pairs, group_ids) in zip(offsets, results):
+            rows.append(group_offset + group_rows)
+            pairs.append(group_pairs)
+            ids += group_ids
+    leaks = pd.DataFrame(
+        {
+            "row": np.concatenate(rows) if rows else np.empty(0, dtype=np.int64),
+            "pair_key": np.concatenate(pairs) if pairs else np.empty(0, dtype=np.uint64),
+            "dataset_id": pd.Series(ids, dtype=object),
+        }
+    )
+    return val, leaks
+
+
+def leakage_report(val, leaks):
+    """Per validation dataset_id: validation rows, how many of them occur in
+    train, the train rows matching them and how many of those come from
+    another dataset."""
+    val = val.assign(leaked=val["pair_key"].isin(leaks["pair_key"]))
+    matches = val.drop_duplicates(["dataset_id", "pair_key"]).merge(
+        leaks, on="pair_key", suffixes=("", "_train")
+    )
+    matches["other_dataset"] = matches["dataset_id_train"] != matches["dataset_id"]
+    report = val.groupby("dataset_id").agg(
+        val_rows=("leaked", "size"), leaked_val_rows=("leaked", "sum")
+    )
+    report["train_matches"] = matches.groupby("dataset_id").size()
+    report["from_other_datasets"] = matches.groupby("dataset_id")["other_dataset"].sum()
+    return report.fillna(0).astype(int).reset_index()
+
+
+def remove_leaks(train_paths, leaks, output, batch_size=10_000):
+    """Write ``train_paths`` without the leaked rows to ``output``."""
+    num_rows = sum(pq.read_metadata(path).num_rows for path in train_paths)
+    keep = np.ones(num_rows, dtype=bool)
+    keep[leaks["row"].to_numpy()] = False
+    write_filtered(train_paths, keep, output, batch_size)
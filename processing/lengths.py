@@ -0,0 +1,206 @@
+"""Token-length statistics and length policies applied before saving.
+
+With a ``LengthPolicy``, ``HFDataset`` tokenizes the final (prompted)
+``source`` and ``target`` of every batch and records the lengths, then
+optionally drops (``"filter"``) or cuts (``"truncate"``) rows over the
+limits. The lengths are kept as exact counts per length, so percentiles are
+exact however many batches a dataset is processed in. They are written to
+``train_<name>.lengths.json`` next to the train output.
+"""
+import itertools
+import json
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from pretokenize import load_tokenizer
+
+ACTIONS = ["none", "filter", "truncate"]
+PERCENTILES = [50, 90, 95, 99]
+
+
+@dataclass
+class LengthPolicy:
+    # directory of a saved fast tokenizer
+    tokenizer: str
+    max_source_tokens: int = None
+    max_target_tokens: int = None
+    # "none" only records lengths, "filter" drops rows over a limit and
+    # "truncate" cuts the text to the limit
+    action: str = "none"
+    batch_size: int = 1_000
+
+    def __post_init__(self):
+        if self.action not in ACTIONS:
+            raise ValueError(f"length policy action must be one of {ACTIONS}")
+
+    def max_tokens(self, column):
+        if column == "source":
+            return self.max_source_tokens
+        return self.max_target_tokens
+
+
+class LengthStats:
+    """Distribution of the token lengths of one column, as a bincount."""
+
+    def __init__(self):
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.truncated = 0
+
+    def add(self, lengths):
+        counts = np.bincount(lengths)
+        if len(counts) > len(self.counts):
+            self.counts = np.pad(self.counts, (0, len(counts) - len(self.counts)))
+        self.counts[: len(counts)] += counts
+
+    def percentile(self, q):
+        cumulative = np.cumsum(self.counts)
+        return int(np.searchsorted(cumulative, np.ceil(q / 100 * cumulative[-1])))
+
+    def histogram(self):
+        """Row counts in power-of-two length buckets, e.g. ``"<=512"``."""
+        histogram = {}
+        low = 0
+        high = 16
+        while low < len(self.counts):
+            histogram[f"<={high}"] = int(self.counts[low : high + 1].sum())
+            low, high = high + 1, high * 2
+        return histogram
+
+    def summary(self):
+        total = int(self.counts.sum())
+        if total == 0:
+            return {"rows": 0}
+        lengths = np.arange(len(self.counts))
+        return {
+            "rows": total,
+            "tokens": int((lengths * self.counts).sum()),
+            "mean": round(float((lengths * self.counts).sum() / total), 1),
+            "min": int(np.flatnonzero(self.counts)[0]),
+            "max": len(self.counts) - 1,
+            **{f"p{q}": self.percentile(q) for q in PERCENTILES},
+            "truncated": self.truncated,
+            "histogram": self.histogram(),
+        }
+
+
+def column_texts(df, column, start, stop):
+    """Rows ``start:stop`` of ``column`` as a list of str, None as ""; only
+    that slice of an Arrow column is converted to Python objects."""
+    if isinstance(df, pa.Table):
+        texts = df[column].slice(start, stop - start).to_pylist()
+    else:
+        texts = df[column].iloc[start:stop].tolist()
+    return [text or "" for text in texts]
+
+
+def text_chunk(df, column, texts):
+    """A list of str as a chunk for ``set_texts``: converted to Arrow right
+    away for a Table, so the Python strings are freed batch by batch."""
+    if isinstance(df, pa.Table):
+        return pa.array(texts, df.schema.field(column).type)
+    return texts
+
+
+def set_texts(df, column, chunks):
+    """Replace ``column`` by the concatenation of ``text_chunk``s."""
+    if isinstance(df, pa.Table):
+        index = df.schema.get_field_index(column)
+        texts = pa.chunked_array(chunks, df.schema.field(column).type)
+        return df.set_column(index, column, texts)
+    df[column] = list(itertools.chain.from_iterable(chunks))
+    return df
+
+
+def truncate(tokenizer, texts, encodings, max_tokens):
+    """Cut texts longer than ``max_tokens`` after the last token that fits,
+    leaving room for the special tokens the tokenizer adds."""
+    keep = max_tokens - tokenizer.num_special_tokens_to_add()
+    texts = list(texts)
+    for i, (ids, offsets) in enumerate(
+        zip(encodings["input_ids"], encodings["offset_mapping"])
+    ):
+        if len(ids) > max_tokens:
+            spans = [span for span in offsets if span[1] > 0]
+            texts[i] = texts[i][: spans[keep - 1][1]] if keep > 0 else ""
+    return texts
+
+
+class LengthProfiler:
+    """Applies a ``LengthPolicy`` to batches and collects ``LengthStats`` per
+    split and column."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.stats = {}
+        self.filtered = {}
+
+    def apply(self, df, split):
+        tokenizer = load_tokenizer(self.policy.tokenizer)
+        keep = np.ones(len(df), dtype=bool)
+        for column in ["source", "target"]:
+            stats = self.stats.setdefault((split, column), LengthStats())
+            max_tokens = self.policy.max_tokens(column)
+            cut = self.policy.action == "truncate" and max_tokens is not None
+            chunks = []
+            for start in range(0, len(df), self.policy.batch_size):
+                stop = start + self.policy.batch_size
+                batch = column_texts(df, column, start, stop)
+                encodings = tokenizer(batch, return_offsets_mapping=cut)
+                lengths = np.fromiter(
+                    map(len, encodings["input_ids"]), np.int64, len(batch)
+                )
+                stats.add(lengths)
+                if max_tokens is not None:
+                    over = lengths > max_tokens
+                    keep[start : start + len(batch)] &= ~over
+                    if cut:
+                        stats.truncated += int(over.sum())
+                        batch = truncate(tokenizer, batch, encodings, max_tokens)
+                        chunks.append(text_chunk(df, column, batch))
+            if cut:
+                df = set_texts(df, column, chunks)
+        if self.policy.action == "filter":
+            self.filtered[split] = self.filtered.get(split, 0) + int((~keep).sum())
+            df = df.filter(pa.array(keep)) if isinstance(df, pa.Table) else df[keep]
+        return df
+
+    def summary(self):
+        summary = {}
+        for (split, column), stats in sorted(self.stats.items()):
+            summary.setdefault(split, {"filtered": self.filtered.get(split, 0)})
+            summary[split][column] = stats.summary()
+        return summary
+
+    def write(self, path, **meta):
+        with open(path, "w") as f:
+            json.dump(
+                {**meta, "policy": vars(self.policy), **self.summary()}, f, indent=2
+            )
+
+
+def read_length_stats(paths):
+    """One row per sidecar file, split and column, without the histograms."""
+    rows = []
+    for path in paths:
+        with open(path) as f:
+            stats = json.load(f)
+        for split in ["train", "val"]:
+            for column in ["source", "target"]:
+                summary = stats.get(split, {}).get(column)
+                if summary is None:
+                    continue
+                summary = {k: v for k, v in summary.items() if k != "histogram"}
+                dataset_id = stats.get("dataset_id") or stats["dataset_name"]
+                rows.append(
+                    {
+                        "dataset_id": dataset_id,
+                        "split": split,
+                        "column": column,
+                        "filtered": stats[split]["filtered"],
+                        **summary,
+                    }
+                )
+    return pd.DataFrame(rows)
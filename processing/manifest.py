@@ -0,0 +1,188 @@
+"""Run manifest: what was produced, from what, and how to check it.
+
+``manifest.json`` next to the outputs lists, per registry dataset, its
+prompt, source revision, processing time and output files, and the merged
+files with the inputs they were merged from (per fragment, for merges into a
+directory, see ``dataset_info.merge_fragments``). Each file entry holds its
+size, row count, schema and a checksum, all taken from the parquet footer:
+
+* ``sha256-footer`` is the SHA-256 of the footer, which records the byte
+  offsets, sizes and statistics of every column chunk, so rewriting the
+  data changes it. Computing or checking it reads the last few KB of the
+  file, never the row data.
+* ``sha256`` (JSON Lines and sidecar files, which have no footer) hashes
+  the whole file.
+
+``validate_manifest`` compares every listed file's size and footer
+checksum with the manifest, which takes milliseconds however large the
+outputs are. Files hashed whole are only checked by size, unless
+``deep=True``.
+"""
+import datetime
+import hashlib
+import json
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+MANIFEST_PATH = "manifest.json"
+MANIFEST_VERSION = 1
+PARQUET_MAGIC = b"PAR1"
+
+
+def source_revision(dataset_dict, revision=None):
+    """Provenance of a loaded ``datasets`` DatasetDict."""
+    split = next(iter(dataset_dict.values()))
+    info = split.info
+    return {
+        "revision": revision,
+        "builder": info.builder_name,
+        "config": info.config_name,
+        "version": str(info.version) if info.version else None,
+        "fingerprint": getattr(split, "_fingerprint", None),
+    }
+
+
+def footer_checksum(path):
+    with open(path, "rb") as f:
+        f.seek(-8, os.SEEK_END)
+        tail = f.read(8)
+        if tail[4:] != PARQUET_MAGIC:
+            raise ValueError(f"{path} is not a parquet file")
+        footer_length = int.from_bytes(tail[:4], "little")
+        f.seek(-8 - footer_length, os.SEEK_END)
+        footer = f.read(footer_length)
+    return "sha256-footer:" + hashlib.sha256(footer).hexdigest()
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return "sha256:" + digest.hexdigest()
+
+
+def checksum(path):
+    if path.endswith(".parquet"):
+        return footer_checksum(path)
+    return file_checksum(path)
+
+
+def schema_fields(schema):
+    return [{"name": field.name, "type": str(field.type)} for field in schema]
+
+
+def file_entry(path, name=None):
+    """Entry for ``path``, listed as ``name`` (default: its base name)."""
+    entry = {"path": name or os.path.basename(path), "bytes": os.path.getsize(path)}
+    if path.endswith(".parquet"):
+        metadata = pq.read_metadata(path)
+        entry.update(
+            format="parquet",
+            num_rows=metadata.num_rows,
+            num_row_groups=metadata.num_row_groups,
+            schema=schema_fields(metadata.schema.to_arrow_schema().remove_metadata()),
+        )
+    else:
+        entry["format"] = "jsonl" if ".jsonl" in path else "json"
+    entry["checksum"] = checksum(path)
+    return entry
+
+
+def read_manifest(path=MANIFEST_PATH):
+    if not os.path.exists(path):
+        return {"manifest_version": MANIFEST_VERSION, "datasets": {}, "merged": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, path=MANIFEST_PATH):
+    manifest["updated"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def update_datasets(entries, path=MANIFEST_PATH):
+    """Add or replace dataset entries, keyed by registry dataset, keeping
+    the entries of datasets not processed in this run."""
+    manifest = read_manifest(path)
+    manifest["datasets"].update(entries)
+    write_manifest(manifest, path)
+    return manifest
+
+
+def update_merged(output, inputs, path=MANIFEST_PATH, **meta):
+    """Record merged file ``output`` and the entries of its ``inputs``. An
+    output rewritten in place (one of its own inputs, e.g. after dedup)
+    keeps the inputs and metadata it was merged with."""
+    manifest = read_manifest(path)
+    name = os.path.basename(output)
+    previous, entries = {}, []
+    for p in inputs:
+        if os.path.abspath(p) == os.path.abspath(output):
+            previous = manifest["merged"].get(name, {})
+            entries += previous.get("inputs", [])
+        else:
+            entries.append(file_entry(p))
+    manifest["merged"][name] = {
+        **previous,
+        **file_entry(output),
+        "inputs": entries,
+        **meta,
+    }
+    write_manifest(manifest, path)
+    return manifest
+
+
+def manifest_files(manifest):
+    """(owner, file entry) of every file the manifest lists."""
+    for name, dataset in manifest["datasets"].items():
+        for entry in dataset.get("files", []):
+            yield name, entry
+    for name, merged in manifest["merged"].items():
+        if "fragments" in merged:
+            for fragment in merged["fragments"].values():
+                yield "merged", fragment["fragment"]
+        else:
+            yield "merged", {k: v for k, v in merged.items() if k != "inputs"}
+
+
+def unchanged(path, entry):
+    """Whether ``path`` still matches its manifest ``entry``, by size and
+    checksum."""
+    return (
+        os.path.exists(path)
+        and os.path.getsize(path) == entry["bytes"]
+        and checksum(path) == entry["checksum"]
+    )
+
+
+def validate_manifest(path=MANIFEST_PATH, directory=None, deep=False):
+    """One row per listed file with ``status`` "ok", "missing", "size" or
+    "checksum". Only sizes and parquet footers are read unless ``deep``."""
+    manifest = read_manifest(path)
+    directory = os.path.dirname(path) if directory is None else directory
+    rows = []
+    for owner, entry in manifest_files(manifest):
+        file_path = os.path.join(directory, entry["path"])
+        if not os.path.exists(file_path):
+            status = "missing"
+        elif os.path.getsize(file_path) != entry["bytes"]:
+            status = "size"
+        elif deep or entry["checksum"].startswith("sha256-footer:"):
+            status = "ok" if checksum(file_path) == entry["checksum"] else "checksum"
+        else:
+            status = "ok"
+        rows.append(
+            {
+                "owner": owner,
+                "path": entry["path"],
+                "num_rows": entry.get("num_rows"),
+                "status": status,
+            }
+        )
+    return pd.DataFrame(rows, columns=["owner", "path", "num_rows", "status"])
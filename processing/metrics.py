@@ -0,0 +1,135 @@
+"""Per-stage wall time, CPU time, memory and row counts of a dataset run.
+
+``HFDataset`` wraps each stage of ``get_datasets`` (load, split, to_pandas,
+rename, process, prompt, select, lengths, save) in ``StageMetrics.stage``.
+Stages run more than once, e.g. once per batch when streaming, add up.
+Memory is the RSS after the stage (from psutil) and the peak RSS during it:
+on Linux the kernel's high-water mark is reset when a stage starts, so the
+peak is the stage's own; elsewhere it is the process peak so far.
+
+Metrics are off by default. ``DISABLED`` then stands in: its ``stage``
+returns a shared no-op context manager, so the cost is one method call per
+stage.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import psutil
+
+MB = 1024**2
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS of this process; False if unsupported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class Stage:
+    """Running totals of one stage. ``rows`` is set by the caller."""
+
+    def __init__(self):
+        self.calls = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.rows = None
+        self.rss = 0
+        self.peak_rss = 0
+
+    def add_rows(self, rows):
+        self.rows = (self.rows or 0) + rows
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "wall_seconds": round(self.wall_seconds, 4),
+            "cpu_seconds": round(self.cpu_seconds, 4),
+            "rows": self.rows,
+            "rss_mb": round(self.rss / MB, 1),
+            "peak_rss_mb": round(self.peak_rss / MB, 1),
+        }
+
+
+class StageMetrics:
+    def __init__(self, **meta):
+        self.meta = meta
+        self.stages = {}
+        self.process = psutil.Process()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        stage = self.stages.setdefault(name, Stage())
+        stage_peak = reset_peak_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stage
+        finally:
+            stage.calls += 1
+            stage.wall_seconds += time.perf_counter() - wall
+            stage.cpu_seconds += time.process_time() - cpu
+            stage.rss = self.process.memory_info().rss
+            peak = peak_rss() if stage_peak else None
+            stage.peak_rss = max(stage.peak_rss, peak or stage.rss)
+
+    def to_dict(self):
+        return {
+            **self.meta,
+            "wall_seconds": round(time.perf_counter() - self.start, 4),
+            "stages": {name: stage.to_dict() for name, stage in self.stages.items()},
+        }
+
+    def write(self, path):
+        """Append the metrics to ``path`` as one JSON line."""
+        line = json.dumps(self.to_dict()) + "\n"
+        # a single write, so lines of concurrent processes do not interleave
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+
+class DisabledStage:
+    def add_rows(self, rows):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class DisabledMetrics:
+    def __init__(self):
+        self.disabled_stage = DisabledStage()
+
+    def stage(self, name):
+        return self.disabled_stage
+
+    def to_dict(self):
+        return {}
+
+    def write(self, path):
+        pass
+
+
+DISABLED = DisabledMetrics()
@@ -0,0 +1,217 @@
+"""Weighted mixing of the per-dataset train outputs.
+
+Concatenating every ``train_<name>.parquet`` lets the largest datasets
+dominate. ``Mixture`` instead draws a fixed number of rows from each
+dataset, in proportion to a rate per ``dataset_id``:
+
+* examples-proportional (the default): rate = min(rows, cap)
+* temperature: rate = min(rows, cap) ** (1 / temperature)
+* explicit ``weights`` per dataset_id
+
+A dataset drawn more often than it has rows is repeated in full passes
+(each in a new order); the remainder is a uniform sample without
+replacement. The rows of all datasets are then interleaved in a random
+order. Everything derives from ``seed``, so a mixture is reproducible.
+
+Each dataset is visited one parquet row group at a time (row groups in a
+random order, rows shuffled within a group), so a mixture can be read
+lazily with ``iter_batches`` while holding one row group per dataset,
+without copying the source files, or written out with ``write``.
+"""
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from writers import conform, merge_schema
+
+SHARD_SUFFIX = re.compile(r"-\d{5}-of-\d{5}$")
+
+
+def output_dataset_id(path, split="train"):
+    """``<name>`` of ``<split>_<name>.parquet`` or of its shards."""
+    name = os.path.basename(path)[: -len(".parquet")]
+    return SHARD_SUFFIX.sub("", name)[len(split) + 1 :]
+
+
+def row_groups(paths, split="train"):
+    """{dataset_id: [(path, row group, rows)]} of per-dataset outputs."""
+    groups = {}
+    for path in sorted(paths):
+        metadata = pq.read_metadata(path)
+        units = groups.setdefault(output_dataset_id(path, split), [])
+        for i in range(metadata.num_row_groups):
+            if metadata.row_group(i).num_rows:
+                units.append((path, i, metadata.row_group(i).num_rows))
+    return groups
+
+
+def mixture_rates(sizes, weights=None, temperature=1.0, cap=None):
+    """Normalized sampling rate of each dataset, given its number of rows."""
+    sizes = pd.Series(sizes, dtype=float)
+    if weights is not None:
+        unknown = set(weights) - set(sizes.index)
+        if unknown:
+            raise ValueError(f"weights for unknown datasets: {sorted(unknown)}")
+        missing = set(sizes.index) - set(weights)
+        if missing:
+            raise ValueError(f"no weights for datasets: {sorted(missing)}")
+        rates = pd.Series(weights, dtype=float).reindex(sizes.index)
+    else:
+        rates = sizes if cap is None else sizes.clip(upper=cap)
+        rates = rates ** (1 / temperature)
+    if (rates < 0).any() or rates.sum() <= 0:
+        raise ValueError("mixture rates must be non-negative and not all zero")
+    return rates / rates.sum()
+
+
+def mixture_counts(rates, num_rows):
+    """Rows to draw from each dataset: ``num_rows`` split by ``rates``,
+    rounding by largest remainder so the counts add up exactly."""
+    exact = rates.to_numpy() * num_rows
+    counts = np.floor(exact).astype(np.int64)
+    remainder = num_rows - counts.sum()
+    counts[np.argsort(counts - exact, kind="stable")[:remainder]] += 1
+    return pd.Series(counts, index=rates.index)
+
+
+def dataset_order(group_sizes, count, rng):
+    """Positions of ``count`` rows of a dataset made of row groups of
+    ``group_sizes`` rows, in the order they are drawn: full passes, then a
+    uniform sample of the remaining rows. Each pass visits the row groups in
+    a random order and the rows of a group in a random order."""
+    group_sizes = np.asarray(group_sizes)
+    group_starts = np.cumsum(group_sizes) - group_sizes
+    num_rows = int(group_sizes.sum())
+    if count and not num_rows:
+        raise ValueError("cannot draw rows from an empty dataset")
+    passes, remainder = divmod(count, num_rows) if num_rows else (0, 0)
+    order = []
+    for i in range(passes + (remainder > 0)):
+        selected = np.ones(num_rows, dtype=bool)
+        if i == passes:
+            selected[:] = False
+            selected[rng.choice(num_rows, remainder, replace=False)] = True
+        for group in rng.permutation(len(group_sizes)):
+            start = group_starts[group]
+            rows = start + np.flatnonzero(selected[start : start + group_sizes[group]])
+            order.append(rng.permutation(rows))
+    return np.concatenate(order) if order else np.empty(0, dtype=np.int64)
+
+
+class DatasetCursor:
+    """Reads the rows of one dataset in ``dataset_order``, holding one row
+    group at a time."""
+
+    def __init__(self, units, order, schema, columns):
+        self.units = units
+        self.unit_starts = np.cumsum([0] + [rows for _, _, rows in units])
+        self.order = order
+        self.schema = schema
+        self.columns = columns
+        self.position = 0
+        self.cached = None, None
+
+    def read_unit(self, unit):
+        if self.cached[0] != unit:
+            path, row_group, _ = self.units[unit]
+            parquet_file = pq.ParquetFile(path)
+            columns = [c for c in self.columns if c in parquet_file.schema_arrow.names]
+            table = parquet_file.read_row_group(row_group, columns=columns)
+            self.cached = unit, conform(table, self.schema)
+        return self.cached[1]
+
+    def take(self, n):
+        rows = self.order[self.position : self.position + n]
+        self.position += n
+        units = np.searchsorted(self.unit_starts, rows, side="right") - 1
+        # rows of one unit are consecutive, see dataset_order
+        bounds = np.flatnonzero(np.diff(units)) + 1
+        tables = []
+        for start, end in zip(np.append(0, bounds), np.append(bounds, len(rows))):
+            unit = units[start]
+            local = rows[start:end] - self.unit_starts[unit]
+            tables.append(self.read_unit(unit).take(local))
+        return pa.concat_tables(tables) if tables else self.schema.empty_table()
+
+
+class Mixture:
+    """A seeded mixture of per-dataset outputs; see the module docstring.
+
+    ``num_rows`` defaults to the rows of all datasets (capped at ``cap`` each
+    if set), so the mixture is as large as the concatenation it replaces.
+    """
+
+    def __init__(self, paths, weights=None, temperature=1.0, cap=None, num_rows=None,
+                 seed=0, split="train", columns=None):
+        self.groups = row_groups(paths, split)
+        self.names = sorted(self.groups)
+        self.sizes = sizes = pd.Series(
+            [sum(rows for _, _, rows in self.groups[name]) for name in self.names],
+            index=self.names,
+            dtype="int64",
+        )
+        self.rates = mixture_rates(sizes, weights, temperature, cap)
+        if num_rows is None:
+            num_rows = int(sizes.sum() if cap is None else sizes.clip(upper=cap).sum())
+        self.counts = mixture_counts(self.rates, num_rows)
+        self.schema = merge_schema(paths)
+        if columns is not None:
+            self.schema = pa.schema([self.schema.field(c) for c in columns])
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        # which dataset each mixed row comes from
+        labels = np.arange(len(self.names), dtype=np.int32)
+        self.labels = rng.permutation(np.repeat(labels, self.counts.to_numpy()))
+        self.orders = [
+            dataset_order(
+                [rows for _, _, rows in self.groups[name]],
+                int(self.counts[name]),
+                np.random.default_rng([seed, i]),
+            )
+            for i, name in enumerate(self.names)
+        ]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def report(self):
+        return pd.DataFrame(
+            {
+                "dataset_id": self.names,
+                "rows": self.sizes.to_numpy(),
+                "rate": self.rates.round(4).to_numpy(),
+                "mixed_rows": self.counts.to_numpy(),
+                "epochs": (self.counts / self.sizes.clip(lower=1)).round(3).to_numpy(),
+            }
+        )
+
+    def iter_batches(self, batch_size=10_000):
+        """Yield the mixed rows as tables of up to ``batch_size`` rows."""
+        cursors = [
+            DatasetCursor(self.groups[name], order, self.schema, self.schema.names)
+            for name, order in zip(self.names, self.orders)
+        ]
+        for start in range(0, len(self), batch_size):
+            labels = self.labels[start : start + batch_size]
+            # rows grouped by dataset, then put back in mixed order
+            grouped = np.argsort(labels, kind="stable")
+            present, counts = np.unique(labels, return_counts=True)
+            table = pa.concat_tables(
+                [cursors[label].take(int(n)) for label, n in zip(present, counts)]
+            )
+            yield table.take(np.argsort(grouped))
+
+    def __iter__(self):
+        for table in self.iter_batches():
+            yield from table.to_pylist()
+
+    def write(self, path, batch_size=10_000):
+        tmp_path = path + ".tmp"
+        with pq.ParquetWriter(tmp_path, self.schema) as writer:
+            for table in self.iter_batches(batch_size):
+                writer.write_table(table)
+        os.replace(tmp_path, path)
@@ -0,0 +1,206 @@
+"""Pack pretokenized examples into fixed-length blocks.
+
+Each block holds up to ``source_length`` source tokens and ``target_length``
+target tokens from several examples. Examples are placed best-fit
+decreasing: longest source first, each into the open block with the least
+room left that still fits both its source and target.
+
+Blocks with the same remaining room are interchangeable, so the packer
+only tracks, per (source room, target room), the list of blocks that have
+it, and places all examples of one (source, target) length pair in bulk.
+The work grows with the number of distinct lengths rather than examples.
+
+The result is a plan next to the pretokenized arrays of ``<prefix>``:
+
+    <prefix>.packed.blocks.npy    int64, block i holds examples[blocks[i]:blocks[i + 1]]
+    <prefix>.packed.examples.npy  int64 example indices in block order
+    <prefix>.packed.json          block lengths and padding efficiency
+
+``PackedDataset`` assembles blocks from the memory-mapped token arrays,
+with segment ids and positions marking the example boundaries.
+"""
+import json
+
+import numpy as np
+
+from pretokenize import TokenizedDataset
+
+
+def plan_paths(prefix):
+    return (
+        f"{prefix}.packed.blocks.npy",
+        f"{prefix}.packed.examples.npy",
+        f"{prefix}.packed.json",
+    )
+
+
+def fits(room, length):
+    """How many items of ``length`` fit in ``room`` (any number if 0)."""
+    return room // length if length else np.iinfo(np.int64).max
+
+
+def pack(source_lengths, target_lengths, source_length, target_length):
+    """Assign examples to blocks; returns the block of every example.
+    Lengths must already be clipped to the block lengths."""
+    n = len(source_lengths)
+    order = np.lexsort((-target_lengths, -source_lengths))
+    pairs = np.stack([source_lengths[order], target_lengths[order]], axis=1)
+    starts = np.flatnonzero(np.any(np.diff(pairs, axis=0, prepend=-1), axis=1))
+    ends = np.append(starts[1:], n)
+    # blocks by remaining (source, target) room, their counts, and per source
+    # room the largest target room any block has (-1 for none)
+    blocks = {}
+    counts = np.zeros((source_length + 1, target_length + 1), dtype=np.int64)
+    max_target_room = np.full(source_length + 1, -1)
+    num_blocks = 0
+
+    def add(room, ids):
+        blocks.setdefault(room, []).extend(ids)
+        counts[room] += len(ids)
+        max_target_room[room[0]] = max(max_target_room[room[0]], room[1])
+
+    def remove(room, used):
+        ids = blocks[room]
+        taken = ids[len(ids) - used :]
+        del ids[len(ids) - used :]
+        counts[room] -= used
+        if not ids:
+            nonempty = np.flatnonzero(counts[room[0]])
+            max_target_room[room[0]] = nonempty[-1] if len(nonempty) else -1
+        return taken
+
+    placed_examples, placed_blocks = [], []
+    for start, end in zip(starts, ends):
+        s, t = (int(v) for v in pairs[start])
+        k = int(end - start)
+        while k > 0:
+            # tightest source room that fits, then tightest target room
+            rows = np.flatnonzero(max_target_room[s:] >= t)
+            if len(rows):
+                room_s = s + int(rows[0])
+                room_t = t + int(np.flatnonzero(counts[room_s, t:])[0])
+            else:
+                room_s, room_t = source_length, target_length
+                per_block = min(fits(room_s, s), fits(room_t, t))
+                new = -(-k // per_block)
+                add((room_s, room_t), range(num_blocks, num_blocks + new))
+                num_blocks += new
+            per_block = min(fits(room_s, s), fits(room_t, t), k)
+            used = min(int(counts[room_s, room_t]), -(-k // per_block))
+            taken = remove((room_s, room_t), used)
+            # every block takes per_block examples, the last one the rest
+            take = np.full(used, per_block)
+            take[-1] = min(per_block, k - per_block * (used - 1))
+            done = end - start - k
+            placed_examples.append(order[start + done : start + done + take.sum()])
+            placed_blocks.append(np.repeat(taken, take))
+            for m in np.unique(take):
+                m = int(m)
+                add(
+                    (room_s - m * s, room_t - m * t),
+                    [b for b, c in zip(taken, take) if c == m],
+                )
+            k -= int(take.sum())
+    block_of = np.empty(n, dtype=np.int64)
+    if placed_examples:
+        block_of[np.concatenate(placed_examples)] = np.concatenate(placed_blocks)
+    return block_of
+
+
+def padding_efficiency(lengths, num_sequences, length):
+    """Fraction of ``num_sequences * length`` token slots holding tokens."""
+    return float(lengths.sum() / (num_sequences * length)) if num_sequences else 0.0
+
+
+def pack_dataset(prefix, source_length=1024, target_length=256):
+    """Pack the pretokenized ``<prefix>`` and write the plan; returns the
+    metadata, including padding efficiency with one example per block
+    ("before") and packed ("after")."""
+    dataset = TokenizedDataset(prefix)
+    source_lengths = dataset.lengths("source")
+    target_lengths = dataset.lengths("target")
+    truncated = int(
+        ((source_lengths > source_length) | (target_lengths > target_length)).sum()
+    )
+    source_lengths = np.minimum(source_lengths, source_length)
+    target_lengths = np.minimum(target_lengths, target_length)
+    block_of = pack(source_lengths, target_lengths, source_length, target_length)
+    examples = np.argsort(block_of, kind="stable")
+    num_blocks = int(block_of.max()) + 1 if len(block_of) else 0
+    blocks = np.searchsorted(block_of[examples], np.arange(num_blocks + 1))
+    blocks_path, examples_path, meta_path = plan_paths(prefix)
+    np.save(blocks_path, blocks)
+    np.save(examples_path, examples)
+    n = len(block_of)
+    meta = {
+        "source_length": source_length,
+        "target_length": target_length,
+        "num_examples": n,
+        "num_blocks": num_blocks,
+        "truncated_examples": truncated,
+        "efficiency_before": {
+            "source": padding_efficiency(source_lengths, n, source_length),
+            "target": padding_efficiency(target_lengths, n, target_length),
+        },
+        "efficiency_after": {
+            "source": padding_efficiency(source_lengths, num_blocks, source_length),
+            "target": padding_efficiency(target_lengths, num_blocks, target_length),
+        },
+    }
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class PackedDataset:
+    """Fixed-length blocks of a packed pretokenized output. Each block is a
+    dict with, per column, ``input_ids`` (0-padded), ``segment_ids`` (1, 2,
+    ... per example, 0 for padding) and ``positions`` within each example."""
+
+    def __init__(self, prefix):
+        blocks_path, examples_path, meta_path = plan_paths(prefix)
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        self.blocks = np.load(blocks_path, mmap_mode="r")
+        self.examples = np.load(examples_path, mmap_mode="r")
+        self.dataset = TokenizedDataset(prefix)
+        self.lengths = {
+            "source": self.meta["source_length"],
+            "target": self.meta["target_length"],
+        }
+
+    def __len__(self):
+        return self.meta["num_blocks"]
+
+    def block_examples(self, i):
+        return self.examples[self.blocks[i] : self.blocks[i + 1]]
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i %= len(self)
+        rows = [self.dataset[int(e)] for e in self.block_examples(i)]
+        block = {}
+        for column, length in self.lengths.items():
+            tokens = [row[column][:length] for row in rows]
+            dtype = tokens[0].dtype if tokens else np.int32
+            input_ids = np.zeros(length, dtype=dtype)
+            segment_ids = np.zeros(length, dtype=np.int32)
+            positions = np.zeros(length, dtype=np.int32)
+            offset = 0
+            for segment, ids in enumerate(tokens, start=1):
+                end = offset + len(ids)
+                input_ids[offset:end] = ids
+                segment_ids[offset:end] = segment
+                positions[offset:end] = np.arange(len(ids))
+                offset = end
+            block[column] = {
+                "input_ids": input_ids,
+                "segment_ids": segment_ids,
+                "positions": positions,
+            }
+        return block
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
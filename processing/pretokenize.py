@@ -0,0 +1,205 @@
+"""Tokenize merged outputs once, into memory-mapped token arrays.
+
+For ``<prefix>.parquet`` and each text column (``source``, ``target``) this
+writes
+
+    <prefix>.<column>.tokens.npy   every row's token ids, concatenated
+    <prefix>.<column>.offsets.npy  int64, row i is tokens[offsets[i]:offsets[i + 1]]
+
+plus ``<prefix>.tokens.json`` describing the tokenizer and counts. Token ids
+are uint16 when the vocabulary fits, int32 otherwise. ``TokenizedDataset``
+opens the arrays with ``mmap_mode="r"`` and returns slices of them, so
+reading an example copies nothing.
+
+Row groups are tokenized in worker processes with a fast (Rust) tokenizer
+loaded from a local directory, so no network access is needed.
+"""
+import functools
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow.parquet as pq
+
+HEADER_SIZE = 128
+
+
+@functools.lru_cache()
+def load_tokenizer(path):
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(path, use_fast=True, local_files_only=True)
+
+
+def token_dtype(vocab_size):
+    return np.dtype(np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.int32)
+
+
+def token_paths(prefix, column):
+    return f"{prefix}.{column}.tokens.npy", f"{prefix}.{column}.offsets.npy"
+
+
+def meta_path(prefix):
+    return f"{prefix}.tokens.json"
+
+
+class NpyAppender:
+    """Append to a 1-d ``.npy`` file whose length is only known at the end.
+
+    The header is written with a fixed size (padded with spaces, which the
+    format allows) and rewritten with the final length by ``close``. The
+    data starts at byte 128, so memory maps of it are aligned.
+    """
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self.file = open(path + ".tmp", "wb")
+        self.write_header()
+
+    def write_header(self):
+        header = repr(
+            {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": False,
+                "shape": (self.length,),
+            }
+        )
+        header = header.ljust(HEADER_SIZE - 11) + "\n"
+        self.file.write(b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little"))
+        self.file.write(header.encode("latin1"))
+
+    def write(self, array):
+        self.file.write(np.ascontiguousarray(array, dtype=self.dtype).tobytes())
+        self.length += len(array)
+
+    def close(self):
+        self.file.seek(0)
+        self.write_header()
+        self.file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+
+def tokenize_row_group(path, row_group, tokenizer_path, columns, dtype, batch_size,
+                       add_special_tokens=True):
+    """{column: (flat token ids, tokens per row)} for one row group."""
+    tokenizer = load_tokenizer(tokenizer_path)
+    tokens = {column: [] for column in columns}
+    lengths = {column: [] for column in columns}
+    for batch in pq.ParquetFile(path).iter_batches(
+        batch_size=batch_size, row_groups=[row_group], columns=columns
+    ):
+        for column in columns:
+            texts = [text or "" for text in batch[column].to_pylist()]
+            ids = tokenizer(texts, add_special_tokens=add_special_tokens)["input_ids"]
+            lengths[column].append(np.fromiter(map(len, ids), np.int64, len(ids)))
+            tokens[column].append(
+                np.fromiter(
+                    itertools.chain.from_iterable(ids),
+                    dtype,
+                    int(lengths[column][-1].sum()),
+                )
+            )
+    return {
+        column: (
+            np.concatenate(tokens[column]) if tokens[column] else np.empty(0, dtype),
+            np.concatenate(lengths[column]) if lengths[column] else np.empty(0, np.int64),
+        )
+        for column in columns
+    }
+
+
+def pretokenize(path, tokenizer_path, columns=("source", "target"), workers=1,
+                batch_size=1_000, add_special_tokens=True):
+    """Tokenize ``path`` (a parquet file) into arrays next to it and return
+    the metadata written to ``<prefix>.tokens.json``."""
+    start = time.perf_counter()
+    prefix = path[: -len(".parquet")] if path.endswith(".parquet") else path
+    tokenizer = load_tokenizer(tokenizer_path)
+    dtype = token_dtype(len(tokenizer))
+    writers = {}
+    for column in columns:
+        tokens_path, offsets_path = token_paths(prefix, column)
+        writers[column] = (
+            NpyAppender(tokens_path, dtype),
+            NpyAppender(offsets_path, np.int64),
+        )
+        writers[column][1].write([0])
+    tokenize = functools.partial(
+        tokenize_row_group,
+        tokenizer_path=tokenizer_path,
+        columns=list(columns),
+        dtype=dtype,
+        batch_size=batch_size,
+        add_special_tokens=add_special_tokens,
+    )
+    row_groups = range(pq.ParquetFile(path).num_row_groups)
+    num_rows = 0
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+        results = (executor.map if workers > 1 else map)(
+            tokenize, [path] * len(row_groups), row_groups
+        )
+        for result in results:
+            for column, (tokens, lengths) in result.items():
+                token_writer, offset_writer = writers[column]
+                offset_writer.write(token_writer.length + np.cumsum(lengths))
+                token_writer.write(tokens)
+            num_rows += len(lengths)
+    meta = {
+        "input": os.path.basename(path),
+        "tokenizer": tokenizer_path,
+        "vocab_size": len(tokenizer),
+        "dtype": dtype.name,
+        "add_special_tokens": add_special_tokens,
+        "num_rows": num_rows,
+        "num_tokens": {},
+    }
+    for column, (token_writer, offset_writer) in writers.items():
+        meta["num_tokens"][column] = token_writer.length
+        token_writer.close()
+        offset_writer.close()
+    seconds = time.perf_counter() - start
+    meta["seconds"] = round(seconds, 2)
+    meta["tokens_per_second"] = round(sum(meta["num_tokens"].values()) / seconds)
+    with open(meta_path(prefix), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class TokenizedDataset:
+    """Examples of a pretokenized output as dicts of token id arrays, which
+    are views of the memory-mapped files."""
+
+    def __init__(self, prefix):
+        with open(meta_path(prefix)) as f:
+            self.meta = json.load(f)
+        self.arrays = {}
+        for column in self.meta["num_tokens"]:
+            tokens_path, offsets_path = token_paths(prefix, column)
+            self.arrays[column] = (
+                np.load(tokens_path, mmap_mode="r"),
+                np.load(offsets_path, mmap_mode="r"),
+            )
+
+    def __len__(self):
+        return self.meta["num_rows"]
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i %= len(self)
+        return {
+            column: tokens[offsets[i] : offsets[i + 1]]
+            for column, (tokens, offsets) in self.arrays.items()
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self, column):
+        return np.diff(self.arrays[column][1])
@@ -0,0 +1,162 @@
+"""Prompt templates applied to whole Arrow columns at once.
+
+A template is a format string over the columns of a row, e.g.
+``"Summarize the following article titled {title}: {source}"`` or
+``"{source}\n\nTL;DR:"``. ``{source}`` is whitespace-stripped like the plain
+prefix prompt always was. Templates are parsed once into the parts
+before and after ``{source}`` and rendered with ``binary_join_element_wise``,
+so there is no per-row Python ``format`` call. A ``PromptSet`` holds several
+weighted templates and picks one per row with a seeded generator.
+``strip_prompts`` goes the other way, recovering the source from prompted
+text so rows can be compared across prompts and datasets.
+"""
+import re
+import string
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+class PromptTemplate:
+    def __init__(self, template, weight=1.0):
+        self.template = template
+        self.weight = weight
+        # [(literal, column or None)] before and after {source}, compiled once
+        self.before, self.after = [], []
+        parts = self.before
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            if spec or conversion:
+                raise ValueError(
+                    f"format specs are not supported in prompt template {template!r}"
+                )
+            if field is not None and not field.isidentifier():
+                raise ValueError(
+                    f"invalid placeholder {{{field}}} in prompt template {template!r}"
+                )
+            if field == "source":
+                if parts is self.after:
+                    raise ValueError(
+                        f"prompt template {template!r} has more than one {{source}}"
+                    )
+                parts.append((literal, None))
+                parts = self.after
+            else:
+                parts.append((literal, field))
+        if parts is self.before:
+            raise ValueError(f"prompt template {template!r} has no {{source}}")
+        self.fields = {"source"} | {
+            field for _, field in self.before + self.after if field is not None
+        }
+
+    @classmethod
+    def from_prefix(cls, prefix, weight=1.0):
+        """The historical ``prefix + source.strip()`` prompt."""
+        return cls(prefix.replace("{", "{{").replace("}", "}}") + "{source}", weight)
+
+    @staticmethod
+    def render_parts(parts, table, string_type):
+        """A scalar for literal-only parts, otherwise an array over ``table``."""
+        if all(field is None for _, field in parts):
+            return pa.scalar("".join(literal for literal, _ in parts), string_type)
+        args = []
+        for literal, field in parts:
+            if literal:
+                args.append(pa.scalar(literal, string_type))
+            if field is not None:
+                column = pc.cast(table[field], string_type)
+                args.append(pc.fill_null(column, pa.scalar("", string_type)))
+        return pc.binary_join_element_wise(*args, pa.scalar("", string_type))
+
+    def render(self, table):
+        """Arrow array with the template filled in for every row of ``table``."""
+        string_type = table["source"].type
+        return join_source(
+            self.render_parts(self.before, table, string_type),
+            table["source"],
+            self.render_parts(self.after, table, string_type),
+        )
+
+    def __repr__(self):
+        return f"PromptTemplate({self.template!r}, weight={self.weight})"
+
+
+def join_source(before, source, after):
+    # utf8_trim_whitespace trims the same code points as str.strip
+    return pc.binary_join_element_wise(
+        before, pc.utf8_trim_whitespace(source), after, pa.scalar("", source.type)
+    )
+
+
+def as_template(template):
+    if isinstance(template, PromptTemplate):
+        return template
+    if isinstance(template, str):
+        return PromptTemplate(template)
+    return PromptTemplate(*template)
+
+
+def parts_pattern(parts):
+    # literals match exactly, other columns match anything
+    return "".join(
+        re.escape(literal) + (".*?" if field is not None else "")
+        for literal, field in parts
+    )
+
+
+def strip_prompts(array, templates):
+    """Remove the text any of ``templates`` put before and after ``{source}``.
+
+    Templates may be anything ``as_template`` accepts. The longest matching
+    prefix and suffix are removed, at most one of each per row.
+    """
+    templates = [as_template(t) for t in templates]
+    for parts, anchor in [("before", "^(?s:{})"), ("after", "(?s:{})$")]:
+        patterns = {parts_pattern(getattr(t, parts)) for t in templates} - {""}
+        if patterns:
+            pattern = anchor.format("|".join(sorted(patterns, key=len, reverse=True)))
+            array = pc.replace_substring_regex(array, pattern, "", max_replacements=1)
+    return array
+
+
+class PromptSet:
+    def __init__(self, templates, seed=0):
+        self.templates = [as_template(t) for t in templates]
+        if not self.templates:
+            raise ValueError("PromptSet needs at least one template")
+        weights = np.array([float(t.weight) for t in self.templates])
+        if (weights < 0).any() or weights.sum() <= 0:
+            raise ValueError(f"invalid prompt template weights {weights.tolist()}")
+        self.weights = weights / weights.sum()
+        self.fields = set().union(*(t.fields for t in self.templates))
+        self.rng = np.random.default_rng(seed)
+
+    @classmethod
+    def from_prompt(cls, prompt, seed=0):
+        """Build from what ``HFDataset`` accepts as ``prompt``: a plain prefix
+        string, a list of templates (strings or ``(template, weight)``
+        pairs) or a ``PromptSet``."""
+        if isinstance(prompt, PromptSet):
+            return prompt
+        if isinstance(prompt, str):
+            return cls([PromptTemplate.from_prefix(prompt)], seed=seed)
+        return cls(prompt, seed=seed)
+
+    def apply(self, table):
+        """Render one sampled template per row of ``table``."""
+        if len(self.templates) == 1:
+            return self.templates[0].render(table)
+        choice = self.rng.choice(len(self.templates), size=table.num_rows, p=self.weights)
+        choice = pa.array(choice.astype(np.int32))
+        # Only the (short) text around {source} differs between templates, so
+        # pick it per row and join with the source column in a single pass.
+        string_type = table["source"].type
+        before = pc.choose(
+            choice,
+            *[t.render_parts(t.before, table, string_type) for t in self.templates],
+        )
+        after = pc.choose(
+            choice,
+            *[t.render_parts(t.after, table, string_type) for t in self.templates],
+        )
+        return join_source(before, table["source"], after)
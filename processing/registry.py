@@ -0,0 +1,258 @@
+"""The dataset registry, hf_datasets.csv: one row per dataset to process.
+
+The first four columns are required; the others are optional, and an
+empty cell takes the default:
+
+* ``hf_dataset_key``, ``source_key``, ``target_key``, ``flan_prompt``; the
+  prompt is a plain prefix to the source, and may be left empty when
+  ``prompt_templates`` is set
+* ``revision``: hub branch, tag or commit to load
+* ``train_split``, ``val_split``: split names (default train, validation)
+* ``data_dir``: local directory to load from, e.g. for wikihow, whose
+  wikihowAll.csv has to be downloaded by hand
+* ``processor``: an ``HFDataset`` subclass, by its name in ``PROCESSORS``
+* ``join_columns``: space-separated list columns to join into strings,
+  see ``transforms.join_lists``
+* ``val_n``: validation rows, instead of ``process --val_n``; 0 writes an
+  empty validation file
+* ``filters``: space-separated ``name=value``, see ``transforms.FILTERS``
+* ``weight``: mixing weight for ``merge --mix``; set for every dataset or
+  for none
+* ``max_rows_per_shard``, ``max_bytes_per_shard``, ``row_group_size``:
+  instead of the ``process`` options of the same name
+* ``prompt_templates``: instead of ``flan_prompt``, a JSON list of
+  ``prompts.PromptTemplate`` templates, each a string or a
+  ``[template, weight]`` pair; one is sampled per row. Templates must
+  contain ``{source}`` and may use other columns of the dataset, e.g.
+  ``[["Summarize the article titled {title}: {source}", 3], "{source} TL;DR:"]``
+
+``read_registry`` parses and checks every row before anything is processed,
+and reports all problems at once.
+"""
+import json
+import os
+from dataclasses import asdict, dataclass, field
+
+import pandas as pd
+
+from dataset import HFDataset
+from prompts import PromptSet
+from transforms import FILTERS
+
+# Processor classes by name. Datasets that need code of their own (a
+# ``process`` or ``process_batch`` override) register their subclass here.
+PROCESSORS = {"HFDataset": HFDataset}
+
+REQUIRED_COLUMNS = ["hf_dataset_key", "source_key", "target_key", "flan_prompt"]
+SHARD_COLUMNS = ["max_rows_per_shard", "max_bytes_per_shard", "row_group_size"]
+
+
+def register_processor(cls):
+    """Class decorator adding an ``HFDataset`` subclass to ``PROCESSORS``."""
+    PROCESSORS[cls.__name__] = cls
+    return cls
+
+
+@dataclass
+class DatasetSpec:
+    hf_dataset_key: str
+    source_key: str
+    target_key: str
+    flan_prompt: str
+    revision: str = None
+    train_split: str = "train"
+    val_split: str = "validation"
+    data_dir: str = None
+    processor: str = "HFDataset"
+    join_columns: list = field(default_factory=list)
+    val_n: int = None
+    filters: dict = field(default_factory=dict)
+    weight: float = None
+    max_rows_per_shard: int = None
+    max_bytes_per_shard: int = None
+    row_group_size: int = None
+    prompt_templates: list = None
+
+    @property
+    def prompt(self):
+        """What ``HFDataset`` takes as ``prompt``: the ``(template, weight)``
+        pairs if the registry sets them, otherwise the prefix."""
+        return self.prompt_templates or self.flan_prompt
+
+    @property
+    def output_id(self):
+        """The ``<name>`` of its ``train_<name>.parquet`` output."""
+        return self.hf_dataset_key.split("/")[0]
+
+    def shard_options(self):
+        """The ``ParquetOptions`` fields this dataset overrides."""
+        return {
+            name: getattr(self, name)
+            for name in SHARD_COLUMNS
+            if getattr(self, name) is not None
+        }
+
+
+def positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise ValueError(f"{value!r} is not a positive integer")
+    return number
+
+
+def non_negative_int(value):
+    number = int(value)
+    if number < 0:
+        raise ValueError(f"{value!r} is negative")
+    return number
+
+
+def non_negative_float(value):
+    number = float(value)
+    if not number >= 0:
+        raise ValueError(f"{value!r} is not a non-negative number")
+    return number
+
+
+def processor_name(value):
+    if value not in PROCESSORS:
+        raise ValueError(f"unknown processor {value!r}, not in {sorted(PROCESSORS)}")
+    return value
+
+
+def parse_filters(value):
+    filters = {}
+    for item in value.split():
+        name, sep, threshold = item.partition("=")
+        if name not in FILTERS:
+            raise ValueError(f"unknown filter {name!r}, not in {sorted(FILTERS)}")
+        if not sep:
+            raise ValueError(f"filter {name!r} has no value")
+        filters[name] = non_negative_int(threshold)
+    return filters
+
+
+def parse_templates(value):
+    items = json.loads(value)
+    if not isinstance(items, list) or not items:
+        raise ValueError("expected a non-empty JSON list of templates")
+    templates = []
+    for item in items:
+        if isinstance(item, str):
+            item = [item, 1.0]
+        if (
+            not isinstance(item, list)
+            or len(item) != 2
+            or not isinstance(item[0], str)
+            or isinstance(item[1], bool)
+            or not isinstance(item[1], (int, float))
+        ):
+            raise ValueError(
+                f"{item!r} is not a template string or [template, weight] pair"
+            )
+        templates.append((item[0], float(item[1])))
+    # compiles every template and checks the weights
+    PromptSet(templates)
+    return templates
+
+
+# Parser of each optional column; required columns are kept as strings
+PARSERS = {
+    "revision": str,
+    "train_split": str,
+    "val_split": str,
+    "data_dir": str,
+    "processor": processor_name,
+    "join_columns": str.split,
+    "val_n": non_negative_int,
+    "filters": parse_filters,
+    "weight": non_negative_float,
+    "max_rows_per_shard": positive_int,
+    "max_bytes_per_shard": positive_int,
+    "row_group_size": positive_int,
+    "prompt_templates": parse_templates,
+}
+
+
+def parse_row(row):
+    """DatasetSpec of a registry row of strings, and a list of problems."""
+    values, problems = {}, []
+    for column in REQUIRED_COLUMNS:
+        # prompt_templates replaces flan_prompt
+        optional = column == "flan_prompt" and row.get("prompt_templates", "").strip()
+        if not row.get(column) and not optional:
+            problems.append(f"{column} is required")
+        values[column] = row.get(column, "")
+    for column, parse in PARSERS.items():
+        value = row.get(column, "")
+        if value.strip() == "":
+            continue
+        try:
+            values[column] = parse(value)
+        except ValueError as e:
+            problems.append(f"{column}: {e}")
+    return DatasetSpec(**values), problems
+
+
+def where(i, spec):
+    # line of the CSV file, counting the header
+    return f"line {i + 2} ({spec.hf_dataset_key or 'no hf_dataset_key'})"
+
+
+def check_specs(specs, check_paths=False):
+    """Problems across registry rows."""
+    problems = []
+    for column in ["hf_dataset_key", "output_id"]:
+        seen = {}
+        for i, spec in enumerate(specs):
+            value = getattr(spec, column)
+            if value in seen:
+                problems.append(
+                    f"{where(i, spec)}: {column} {value!r} is also used on "
+                    f"{where(seen[value], specs[seen[value]])}"
+                )
+            seen.setdefault(value, i)
+    weighted = [spec.weight is not None for spec in specs]
+    if any(weighted) and not all(weighted):
+        for i, spec in enumerate(specs):
+            if spec.weight is None:
+                problems.append(f"{where(i, spec)}: weight is set for other datasets")
+    if check_paths:
+        for i, spec in enumerate(specs):
+            if spec.data_dir is not None and not os.path.isdir(spec.data_dir):
+                problems.append(
+                    f"{where(i, spec)}: data_dir {spec.data_dir!r} does not exist"
+                )
+    return problems
+
+
+def read_registry(path="hf_datasets.csv", check_paths=False):
+    """DatasetSpecs of the registry at ``path``, in order. Raises ValueError
+    listing every problem found; with ``check_paths``, also that every
+    ``data_dir`` exists."""
+    # strings throughout: empty cells stay empty and prompts keep their spaces
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    problems = []
+    unknown = set(df.columns) - set(REQUIRED_COLUMNS) - set(PARSERS)
+    if unknown:
+        problems.append(f"unknown columns {sorted(unknown)}")
+    specs = []
+    for i, row in enumerate(df.to_dict("records")):
+        spec, row_problems = parse_row(row)
+        specs.append(spec)
+        problems += [f"{where(i, spec)}: {problem}" for problem in row_problems]
+    problems += check_specs(specs, check_paths)
+    if problems:
+        raise ValueError(f"invalid registry {path}:\n" + "\n".join(problems))
+    return specs
+
+
+def registry_table(specs):
+    return pd.DataFrame([asdict(spec) for spec in specs])
+
+
+def registry_weights(specs):
+    """Mixing weights by output dataset_id, or None if the registry has none."""
+    if not specs or specs[0].weight is None:
+        return None
+    return {spec.output_id: spec.weight for spec in specs}
@@ -0,0 +1,124 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+def batched(iterable, n):
+    """Yield lists of up to ``n`` items from ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, n))
+        if not batch:
+            return
+        yield batch
+
+
+def hash_key(seed):
+    """16 character key for pandas' SipHash, derived from an integer seed."""
+    return f"{seed:016d}"[-16:]
+
+
+def position_hashes(positions, seed=0):
+    """Stable 64-bit hash of uint64 row positions under ``seed``.
+
+    pandas hashes integers with a fixed mixer that ignores ``hash_key``
+    (and maps 0 to 0), so the positions are first XOR-ed with a 64-bit value
+    derived from the seed by SipHash.
+    """
+    key = hash_key(seed)
+    mask = pd.util.hash_array(np.array([key], dtype=object), hash_key=key)[0]
+    return pd.util.hash_array(positions ^ np.uint64(mask))
+
+
+def column_strings(column):
+    """String view of an Arrow column for hashing; list columns are joined."""
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        column = pc.binary_join(column, "\x1f")
+    elif not pa.types.is_string(column.type) and not pa.types.is_large_string(
+        column.type
+    ):
+        column = pc.cast(column, pa.string())
+    return column.to_pandas()
+
+
+def row_hashes(table, columns=None, offset=0, seed=0):
+    """Stable 64-bit hash of each row's ``columns`` (or of its position,
+    ``offset + i``, when ``columns`` is None). pandas' hashing is seeded by a
+    fixed key, so values are identical across runs and machines."""
+    if columns is None:
+        positions = np.arange(offset, offset + table.num_rows, dtype=np.uint64)
+        return position_hashes(positions, seed)
+    df = pd.DataFrame({c: column_strings(table[c]) for c in columns})
+    hashes = pd.util.hash_pandas_object(df, index=False, hash_key=hash_key(seed))
+    return hashes.to_numpy()
+
+
+def sample_indices(n, k, seed=0, chunk_size=1 << 20):
+    """``k`` of the row indices ``range(n)``, ordered by their position hash.
+
+    This is the selection ``HashSplitter(k, columns=None)`` makes, computed
+    from positions alone so the rows themselves never have to be read.
+    Positions are hashed a chunk at a time, keeping only the current
+    bottom-k, so memory is O(k + chunk_size) however large ``n`` is.
+    """
+    best = np.empty(0, dtype=np.int64)
+    best_hashes = np.empty(0, dtype=np.uint64)
+    for start in range(0, n, chunk_size):
+        positions = np.arange(start, min(start + chunk_size, n), dtype=np.uint64)
+        hashes = np.concatenate([best_hashes, position_hashes(positions, seed)])
+        candidates = np.concatenate([best, positions.astype(np.int64)])
+        if len(candidates) > k:
+            keep = np.argpartition(hashes, k - 1)[:k] if k > 0 else []
+            candidates, hashes = candidates[keep], hashes[keep]
+        best, best_hashes = candidates, hashes
+    return best[np.argsort(best_hashes, kind="stable")]
+
+
+class HashSplitter:
+    """Deterministic single-pass train/validation split.
+
+    Validation is the ``val_n`` rows with the smallest row hash (bottom-k).
+    ``split`` is fed the table batch by batch and returns the rows that are
+    definitely train; only the current ``val_n`` candidates are held back,
+    and ``finalize`` returns them. The split depends only on row content (or
+    position) and the seed, not on batch boundaries or machine.
+    """
+
+    def __init__(self, val_n, columns=None, seed=0):
+        self.val_n = val_n
+        self.columns = columns
+        self.seed = seed
+        self.offset = 0
+        # of the first table fed, so that an empty validation keeps it
+        self.schema = None
+        self.val = None
+        self.val_hashes = np.empty(0, dtype=np.uint64)
+
+    def split(self, table):
+        if self.schema is None:
+            self.schema = table.schema
+        if self.val_n <= 0:
+            return table
+        hashes = row_hashes(table, self.columns, self.offset, self.seed)
+        self.offset += table.num_rows
+        if self.val is not None:
+            table = pa.concat_tables([self.val, table.cast(self.val.schema)])
+            hashes = np.concatenate([self.val_hashes, hashes])
+        if table.num_rows <= self.val_n:
+            self.val, self.val_hashes = table, hashes
+            return table.slice(0, 0)
+        val_idx = np.argpartition(hashes, self.val_n - 1)[: self.val_n]
+        is_val = np.zeros(table.num_rows, dtype=bool)
+        is_val[val_idx] = True
+        self.val, self.val_hashes = table.take(val_idx), hashes[val_idx]
+        return table.filter(pa.array(~is_val))
+
+    def finalize(self):
+        """The validation rows, ordered by hash; an empty table with the
+        schema fed (no columns if nothing was) when there are none."""
+        if self.val is None:
+            return self.schema.empty_table() if self.schema else pa.table({})
+        return self.val.take(np.argsort(self.val_hashes, kind="stable"))
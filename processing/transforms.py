@@ -0,0 +1,112 @@
+"""Batched transforms over Arrow tables, optionally in worker processes.
+
+``map_batches`` cuts a table into record batches of ``batch_size`` rows,
+applies a function to each (as a one-batch ``pa.Table``) and concatenates
+the results in order. With ``num_proc > 1`` the batches are sent to worker
+processes; Arrow data is pickled as raw buffers, so this costs a copy of
+the batch, not a conversion to Python objects.
+
+``HFDataset.process_batch`` and ``HFDataset.process_example`` are the hooks
+built on it: a subclass overriding either gets it applied to train and
+validation with ``num_proc`` workers, before ``process``.
+
+``join_lists`` turns a column of lists of strings (e.g. the sentences of
+scitldr) into one string per row, with Arrow's ``binary_join`` kernel. Null
+sentences are filled in on the flattened values, and the list rebuilt from
+the original offsets, so no per-row Python objects are created. Registry
+datasets opt in with ``join_columns``.
+
+``filter_rows`` drops rows by the ``FILTERS`` of a registry dataset.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+def apply_batch(fn, batch):
+    return fn(pa.Table.from_batches([batch]))
+
+
+def map_batches(table, fn, num_proc=1, batch_size=10_000):
+    """``fn`` applied to ``table`` in batches of ``batch_size`` rows. ``fn``
+    must return the same schema for every batch, and be picklable when
+    ``num_proc > 1``, e.g. a module-level function or a method of a
+    picklable object."""
+    batches = table.to_batches(max_chunksize=batch_size)
+    if not batches:
+        return fn(table)
+    if num_proc <= 1 or len(batches) == 1:
+        results = [apply_batch(fn, batch) for batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=min(num_proc, len(batches))) as executor:
+            results = list(executor.map(apply_batch, [fn] * len(batches), batches))
+    return pa.concat_tables(results)
+
+
+def rows_to_batch(fn, table):
+    """Apply a function of one example (a dict) to every row of ``table``."""
+    if table.num_rows == 0:
+        return table
+    return pa.Table.from_pylist([fn(example) for example in table.to_pylist()])
+
+
+def join_list_array(array, separator="\n"):
+    if pa.types.is_null(array.type):
+        # e.g. a column of no rows, or only nulls, converted from pandas
+        return pa.nulls(len(array), pa.string())
+    if not (pa.types.is_list(array.type) or pa.types.is_large_list(array.type)):
+        raise ValueError(f"cannot join a column of type {array.type}")
+    offsets = array.offsets
+    first = offsets[0].as_py()
+    values = array.values.slice(first, offsets[-1].as_py() - first)
+    if not (pa.types.is_string(values.type) or pa.types.is_large_string(values.type)):
+        values = pc.cast(values, pa.string())
+    elif not values.null_count:
+        return pc.binary_join(array, pa.scalar(separator, values.type))
+    # the same lists over the new values; offsets rebased for slices
+    array = type(array).from_arrays(
+        pc.subtract(offsets, offsets[0]),
+        pc.fill_null(values, ""),
+        mask=array.is_null() if array.null_count else None,
+    )
+    return pc.binary_join(array, pa.scalar(separator, values.type))
+
+
+def join_lists(column, separator="\n"):
+    """Each list of ``column`` (an Array or ChunkedArray) joined into one
+    string with ``separator``. Null elements count as empty strings and null
+    lists stay null."""
+    if isinstance(column, pa.ChunkedArray):
+        chunks = [join_list_array(chunk, separator) for chunk in column.chunks]
+        return pa.chunked_array(chunks, type=chunks[0].type if chunks else pa.string())
+    return join_list_array(column, separator)
+
+
+def join_list_columns(table, columns, separator="\n"):
+    for column in columns:
+        index = table.schema.get_field_index(column)
+        table = table.set_column(index, column, join_lists(table[column], separator))
+    return table
+
+
+# name: (column, comparison) of the column's length in characters
+FILTERS = {
+    "min_source_chars": ("source", pc.greater_equal),
+    "max_source_chars": ("source", pc.less_equal),
+    "min_target_chars": ("target", pc.greater_equal),
+    "max_target_chars": ("target", pc.less_equal),
+}
+
+
+def filter_rows(table, filters):
+    """Rows of ``table`` passing all ``filters``, {name in FILTERS: value}.
+    Rows with a null in a filtered column are dropped."""
+    mask = None
+    for name, value in filters.items():
+        column, compare = FILTERS[name]
+        keep = compare(pc.utf8_length(table[column]), value)
+        mask = keep if mask is None else pc.and_(mask, keep)
+    if mask is None:
+        return table
+    return table.filter(pc.fill_null(mask, False))
@@ -0,0 +1,245 @@
+import glob
+import json
+import os
+from dataclasses import asdict, dataclass
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+JSONL_EXTENSIONS = {None: ".jsonl", "gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+
+@dataclass
+class ParquetOptions:
+    # Shard limits; a new shard is started once either is reached. Bytes are
+    # measured on the uncompressed Arrow data, so files end up smaller.
+    max_rows_per_shard: int = None
+    max_bytes_per_shard: int = None
+    row_group_size: int = None
+    compression: str = "snappy"
+    use_dictionary: bool = True
+
+    @property
+    def sharded(self):
+        return bool(self.max_rows_per_shard or self.max_bytes_per_shard)
+
+
+def shard_path(prefix, index, total):
+    return f"{prefix}-{index:05d}-of-{total:05d}.parquet"
+
+
+def index_path(prefix):
+    return f"{prefix}.index.json"
+
+
+def lengths_path(prefix):
+    return f"{prefix}.lengths.json"
+
+
+def output_files(prefix):
+    """Existing output files for ``prefix``: ``<prefix>.parquet`` or its
+    shards, plus the shard index and token length statistics."""
+    paths = glob.glob(f"{glob.escape(prefix)}.parquet")
+    paths += sorted(glob.glob(f"{glob.escape(prefix)}-?????-of-?????.parquet"))
+    for path in [index_path(prefix), lengths_path(prefix)]:
+        if os.path.exists(path):
+            paths.append(path)
+    for ext in JSONL_EXTENSIONS.values():
+        if os.path.exists(prefix + ext):
+            paths.append(prefix + ext)
+    return paths
+
+
+def merge_schema(dataset_items):
+    """Union of the input schemas, without the ``__index_level_N__`` columns
+    pandas writes for non-default indexes."""
+    schemas = []
+    for dataset_item in dataset_items:
+        schema = pq.read_schema(dataset_item).remove_metadata()
+        # pandas writes string, datasets may write large_string
+        schemas.append(
+            pa.schema(
+                [
+                    f.with_type(pa.string()) if f.type == pa.large_string() else f
+                    for f in schema
+                ]
+            )
+        )
+    schema = pa.unify_schemas(schemas)
+    return pa.schema([f for f in schema if not f.name.startswith("__index_level_")])
+
+
+def conform(table, schema):
+    """Reorder/cast ``table`` to ``schema``, adding all-null missing columns."""
+    columns = [
+        table[field.name].cast(field.type)
+        if field.name in table.column_names
+        else pa.nulls(table.num_rows, field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def remove_outputs(prefix):
+    for path in output_files(prefix):
+        os.remove(path)
+
+
+class ShardedParquetWriter:
+    """Write tables to ``<prefix>.parquet``, or, when ``options`` sets a shard
+    limit, to ``<prefix>-00000-of-000NN.parquet`` shards described by a
+    ``<prefix>.index.json`` manifest.
+
+    The shard count is only known at the end, so shards are written to
+    temporary names and renamed by ``close``. Any previous outputs for the
+    prefix are removed first.
+    """
+
+    def __init__(self, prefix, options=None):
+        self.prefix = prefix
+        self.options = options or ParquetOptions()
+        self.shards = []  # [[path, num rows]]
+        self.writer = None
+        self.schema = None
+        self.shard_rows = 0
+        self.shard_bytes = 0
+        remove_outputs(prefix)
+
+    def open_shard(self, schema):
+        if self.options.sharded:
+            path = f"{self.prefix}-{len(self.shards):05d}.parquet.tmp"
+        else:
+            path = f"{self.prefix}.parquet"
+        self.writer = pq.ParquetWriter(
+            path,
+            schema,
+            compression=self.options.compression,
+            use_dictionary=self.options.use_dictionary,
+        )
+        self.shards.append([path, 0])
+        self.shard_rows = 0
+        self.shard_bytes = 0
+
+    def close_shard(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def rows_left(self, row_bytes):
+        """Rows that still fit in the current shard (at least one), or None
+        when unsharded."""
+        limits = []
+        if self.options.max_rows_per_shard:
+            limits.append(self.options.max_rows_per_shard - self.shard_rows)
+        if self.options.max_bytes_per_shard and row_bytes:
+            limits.append(
+                int((self.options.max_bytes_per_shard - self.shard_bytes) // row_bytes)
+            )
+        return max(min(limits), 1) if limits else None
+
+    def shard_full(self, row_bytes):
+        max_rows = self.options.max_rows_per_shard
+        max_bytes = self.options.max_bytes_per_shard
+        return bool(
+            (max_rows and self.shard_rows >= max_rows)
+            or (max_bytes and self.shard_bytes + row_bytes > max_bytes)
+        )
+
+    def write(self, table):
+        if self.schema is None:
+            self.schema = table.schema
+        table = table.cast(self.schema)
+        row_bytes = table.nbytes / table.num_rows if table.num_rows else 0
+        offset = 0
+        while offset < table.num_rows:
+            if self.writer is None:
+                self.open_shard(self.schema)
+            chunk = table.slice(offset, self.rows_left(row_bytes))
+            self.writer.write_table(chunk, row_group_size=self.options.row_group_size)
+            self.shards[-1][1] += chunk.num_rows
+            self.shard_rows += chunk.num_rows
+            self.shard_bytes += chunk.num_rows * row_bytes
+            offset += chunk.num_rows
+            if self.shard_full(row_bytes):
+                self.close_shard()
+
+    def close(self):
+        """Finish writing; returns the written parquet paths."""
+        if self.writer is None and not self.shards and self.schema is not None:
+            self.open_shard(self.schema)
+        self.close_shard()
+        if not self.options.sharded:
+            return [path for path, _ in self.shards]
+        paths = []
+        shards = []
+        for i, (tmp_path, num_rows) in enumerate(self.shards):
+            path = shard_path(self.prefix, i, len(self.shards))
+            os.replace(tmp_path, path)
+            paths.append(path)
+            shards.append({"path": os.path.basename(path), "num_rows": num_rows})
+        with open(index_path(self.prefix), "w") as f:
+            json.dump(
+                {
+                    "num_rows": sum(s["num_rows"] for s in shards),
+                    "shards": shards,
+                    "options": asdict(self.options),
+                },
+                f,
+                indent=2,
+            )
+        return paths
+
+
+def write_parquet(table, prefix, options=None):
+    writer = ShardedParquetWriter(prefix, options)
+    writer.write(table)
+    return writer.close()
+
+
+class JsonLinesWriter:
+    """Append tables to a JSON Lines file, one object per row, optionally
+    gzip or zstd compressed. Rows are serialized ``batch_size`` at a time,
+    however large the table passed to ``write``, so memory does not depend on
+    the size of the output."""
+
+    def __init__(self, prefix, compression=None, batch_size=10_000):
+        self.path = prefix + JSONL_EXTENSIONS[compression]
+        self.batch_size = batch_size
+        remove_outputs(prefix)
+        if compression is None:
+            self.stream = pa.OSFile(self.path, "wb")
+        else:
+            self.stream = pa.CompressedOutputStream(self.path, compression)
+
+    def write(self, table):
+        for batch in table.to_batches(max_chunksize=self.batch_size):
+            if batch.num_rows == 0:
+                continue
+            text = batch.to_pandas().to_json(
+                orient="records", lines=True, force_ascii=False
+            )
+            if not text.endswith("\n"):
+                text += "\n"
+            self.stream.write(text.encode("utf-8"))
+
+    def close(self):
+        self.stream.close()
+        return [self.path]
+
+
+def read_jsonl(path, chunk_size=1 << 20):
+    """Lazily yield the rows of a (possibly compressed) JSON Lines file."""
+    compression = "detect" if path.endswith((".gz", ".zst")) else None
+    with pa.input_stream(path, compression=compression) as stream:
+        remainder = b""
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            for line in lines:
+                if line:
+                    yield json.loads(line)
+        if remainder.strip():
+            yield json.loads(remainder)